@@ -0,0 +1,342 @@
+"""
+Reproducible performance benchmarks of the OSD pipeline.
+
+Synthetic OSD, SRT and video fixtures are generated in a temporary folder,
+so the suite runs anywhere, no GPU or real recordings are needed. Results
+are written as a JSON baseline that later runs can be compared against:
+
+    python benchmark.py run --output baseline.json
+    python benchmark.py compare baseline.json
+"""
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from processor import (Frame, OsdFont, OsdGenConfig, OsdGenerator, OSDRecords,
+                       OverlaySink, SrtFile, Utils)
+
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources")
+
+RESOLUTIONS = {
+    "720p": (1280, 720, "user_bf_24.png"),
+    "1080p": (1920, 1080, "user_bf_36.png"),
+    "1440p": (2560, 1440, "user_bf_36.png"),
+}
+
+FPS = 60
+OSD_INTERVAL_MS = 33
+SRT_INTERVAL_MS = 100
+
+
+def make_osd(path, fc_type, record_count, seed=0):
+    """
+    Writes an OSD recording with the 40 byte header and record_count
+    records. Every third record changes a few cells, like a live OSD.
+    """
+    rng = np.random.default_rng(seed)
+    records = np.zeros(record_count, dtype=OSDRecords.RECORD_DTYPE)
+    records["startTime"] = np.arange(record_count) * OSD_INTERVAL_MS
+
+    glyphs = np.full((Frame.frame_h, Frame.frame_w), 32, dtype=np.uint16)
+    # A few static elements and numbers that keep changing
+    glyphs[1, 2:12] = rng.integers(48, 58, 10)
+    glyphs[18, 40:50] = rng.integers(48, 58, 10)
+    glyphs[10, 20:30] = rng.integers(1, 255, 10)
+    for i in range(record_count):
+        if i % 3 == 0:
+            glyphs[1, 8:12] = rng.integers(48, 58, 4)
+            glyphs[18, 46:50] = rng.integers(48, 58, 4)
+        records["glyphs"][i] = glyphs
+
+    with open(path, "wb") as f:
+        f.write(fc_type.encode("utf-8").ljust(OSDRecords.HEADER_SIZE, b"\0"))
+        records.tofile(f)
+
+
+def make_srt(path, duration_ms):
+    def timestamp(ms):
+        return "%02d:%02d:%02d,%03d" % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+
+    with open(path, "w") as f:
+        for i, start in enumerate(range(0, duration_ms, SRT_INTERVAL_MS)):
+            f.write("%d\n%s --> %s\n" % (i + 1, timestamp(start), timestamp(start + SRT_INTERVAL_MS)))
+            f.write("Signal:4 CH:1 FlightTime:%d SBat:4.2V GBat:0.0V Delay:25ms "
+                    "Bitrate:25Mbps Distance:%dm\n\n" % (start // 1000, i))
+
+
+def make_video(path, width, height, seconds):
+    """
+    Encodes a test pattern with ffmpeg lavfi, falls back to OpenCV when
+    ffmpeg is not installed.
+    """
+    if shutil.which("ffmpeg"):
+        subprocess.run([
+            "ffmpeg", "-y", "-f", "lavfi",
+            "-i", "testsrc2=size=%dx%d:rate=%d:duration=%s" % (width, height, FPS, seconds),
+            "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", path
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return
+
+    logging.warning("ffmpeg not found, generating %s with OpenCV" % path)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), FPS, (width, height))
+    gradient = np.linspace(0, 255, width, dtype=np.uint8)
+    for i in range(int(seconds * FPS)):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:] = np.roll(gradient, i * 8)[np.newaxis, :, np.newaxis]
+        writer.write(frame)
+    writer.release()
+
+
+class Fixtures:
+    """
+    Synthetic inputs for one run, removed by cleanup().
+    """
+
+    def __init__(self, resolutions, seconds):
+        self.folder = tempfile.mkdtemp(prefix="ws_osd_bench_")
+        self.seconds = seconds
+        duration_ms = int(seconds * 1000)
+        record_count = duration_ms // OSD_INTERVAL_MS + 1
+
+        self.osd = {}
+        for fc_type in ("BTFL", "ARDU", "INAV"):
+            self.osd[fc_type] = os.path.join(self.folder, "%s.osd" % fc_type.lower())
+            make_osd(self.osd[fc_type], fc_type, record_count)
+        self.srt = os.path.join(self.folder, "clip.srt")
+        make_srt(self.srt, duration_ms)
+
+        self.videos = {}
+        for name in resolutions:
+            width, height, _ = RESOLUTIONS[name]
+            self.videos[name] = os.path.join(self.folder, "clip_%s.mp4" % name)
+            make_video(self.videos[name], width, height, seconds)
+
+    def get_config(self, resolution, **kwargs):
+        _, _, font = RESOLUTIONS[resolution]
+        config = dict(
+            video_path=self.videos[resolution], osd_path=self.osd["BTFL"],
+            font_path=os.path.join(RESOURCES, font), srt_path=self.srt,
+            output_path=os.path.join(self.folder, "out_%s" % resolution),
+            offset_left=0, offset_top=0, osd_zoom=100, render_upscale=False,
+            include_srt=True, hide_sensitive_osd=False, use_hw=False, fast_srt=False)
+        config.update(kwargs)
+        return OsdGenConfig(**config)
+
+    def clean_output(self, config: OsdGenConfig):
+        shutil.rmtree(config.output_path, ignore_errors=True)
+        for suffix in ("_osd.mp4", "_profile.json"):
+            if os.path.exists(config.output_path + suffix):
+                os.remove(config.output_path + suffix)
+
+    def cleanup(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class Benchmark:
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}
+
+    def measure(self, name, fn, number=1, setup=None):
+        """
+        Runs fn number times per repeat and records the seconds per call,
+        setup runs before every repeat and isn't timed. Single calls that
+        are too quick to time on their own need a higher number.
+        """
+        timings = []
+        if number > 1:
+            # Warm up caches and lazy initialisation
+            fn()
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            timings.append((time.perf_counter() - start) / number)
+
+        self.results[name] = {
+            "median": statistics.median(timings),
+            "best": min(timings),
+            "repeat": self.repeat,
+            "number": number,
+        }
+        print("%-40s %10.3f ms" % (name, self.results[name]["median"] * 1000))
+
+
+def run_suite(resolutions, seconds, repeat, include_render=True):
+    fixtures = Fixtures(resolutions, seconds)
+    bench = Benchmark(repeat)
+    records = OSDRecords(fixtures.osd["INAV"])
+    raw = records.raw[len(records) // 2]
+    try:
+        for font_name in ("user_bf_24.png", "user_bf_36.png"):
+            font = OsdFont(os.path.join(RESOURCES, font_name))
+            label = "hd" if font.is_hd() else "sd"
+
+            bench.measure("frame_decode[%s]" % label,
+                          lambda: Frame(raw, font).get_osd_frame_glyphs(hide=False), number=2000)
+            bench.measure("frame_decode_masked[%s]" % label,
+                          lambda: Frame(raw, font).get_osd_frame_glyphs(hide=True), number=2000)
+            glyphs = Frame(raw, font).get_osd_frame_glyphs(hide=False)
+            bench.measure("osd_assembly[%s]" % label,
+                          lambda: font.render_glyphs(glyphs), number=100)
+
+        srt_line = SrtFile(fixtures.srt).get_line(0)
+        for resolution in resolutions:
+            width, height, font_name = RESOLUTIONS[resolution]
+            font = OsdFont(os.path.join(RESOURCES, font_name))
+            osd_frame = font.render_glyphs(Frame(raw, font).get_osd_frame_glyphs(hide=False))
+            video_frame = np.zeros((height, width, 3), dtype=np.uint8)
+            overlay = np.zeros((height, width, 4), dtype=np.uint8)
+
+            bench.measure("overlay_image_alpha[%s]" % resolution,
+                          lambda: Utils.overlay_image_alpha(video_frame, osd_frame, 0, 0, 100), number=5)
+            for fast in (True, False):
+                bench.measure("srt_overlay[%s,%s]" % ("fast" if fast else "text", resolution),
+                              lambda: Utils.overlay_srt_line(fast, overlay, srt_line, font.get_srt_font_size(), 150),
+                              number=100)
+
+            config = fixtures.get_config(resolution)
+
+            def write_png_frames():
+                sink = OverlaySink.create(config, FPS, (width, height))
+                sink.open()
+                for frame_no in range(1, 31):
+                    sink.write(frame_no, overlay, True)
+                sink.close()
+
+            os.makedirs(config.output_path, exist_ok=True)
+            bench.measure("png_sink_30_frames[%s]" % resolution, write_png_frames,
+                          setup=lambda: fixtures.clean_output(config) or os.makedirs(config.output_path))
+
+            for sparse in (False, True):
+                config = fixtures.get_config(resolution, sparse_output=sparse)
+                bench.measure("main%s[%s]" % ("_sparse" if sparse else "", resolution),
+                              lambda: OsdGenerator(config).main(),
+                              setup=lambda: fixtures.clean_output(config))
+
+            if include_render:
+                config = fixtures.get_config(resolution, sparse_output=True)
+                fixtures.clean_output(config)
+                gen = OsdGenerator(config)
+                gen.main()
+                bench.measure("render[%s]" % resolution, gen.render)
+                fixtures.clean_output(config)
+    finally:
+        fixtures.cleanup()
+
+    return {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": multiprocessing.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "resolutions": list(resolutions),
+            "seconds": seconds,
+            "repeat": repeat,
+            "render": include_render,
+        },
+        "results": bench.results,
+    }
+
+
+def compare(baseline, current, threshold):
+    """
+    Prints the change of every benchmark and returns the names of the ones
+    that got slower than threshold (a fraction) compared to baseline. The
+    best run is compared, it is the least affected by other load.
+    """
+    regressions = []
+    print("%-40s %12s %12s %9s" % ("benchmark", "baseline ms", "current ms", "change"))
+    for name, base in baseline["results"].items():
+        result = current["results"].get(name)
+        if result is None:
+            print("%-40s %12.3f %12s %9s" % (name, base["best"] * 1000, "-", "missing"))
+            continue
+        change = result["best"] / base["best"] - 1 if base["best"] else 0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("%-40s %12.3f %12.3f %+8.1f%%%s" % (
+            name, base["best"] * 1000, result["best"] * 1000, change * 100, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Benchmark suite for the OSD generator")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the suite and store the results")
+    run_parser.add_argument("--output", default="benchmark.json",
+                            help="JSON file to write the results to")
+
+    compare_parser = commands.add_parser(
+        "compare", help="Compare against a baseline, exits with 1 on a regression")
+    compare_parser.add_argument("baseline", help="Baseline JSON written by run")
+    compare_parser.add_argument("--current",
+                                help="Results to compare, the suite is run with "
+                                     "the baseline settings when omitted")
+    compare_parser.add_argument("--output", help="Also store the new results here")
+    compare_parser.add_argument("--threshold", type=float, default=10,
+                                help="Slowdown in percent reported as regression")
+
+    run_parser.add_argument("--resolutions", nargs="+", choices=list(RESOLUTIONS),
+                            default=list(RESOLUTIONS))
+    run_parser.add_argument("--seconds", type=float, default=2,
+                            help="Length of the synthetic clips")
+    run_parser.add_argument("--repeat", type=int, default=3,
+                            help="Repetitions of every measurement")
+    for p in (run_parser, compare_parser):
+        p.add_argument("--no-render", action="store_true", default=False,
+                       help="Skip the ffmpeg render benchmarks")
+
+    args = parser.parse_args()
+    # The pipeline logs every clip at info level
+    logging.basicConfig(level=logging.WARNING)
+    include_render = not args.no_render and shutil.which("ffmpeg") is not None
+    if not args.no_render and not include_render:
+        print("ffmpeg not found, skipping render benchmarks")
+
+    if args.command == "run":
+        results = run_suite(args.resolutions, args.seconds, args.repeat, include_render)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results written to %s" % args.output)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if args.current:
+            with open(args.current) as f:
+                current = json.load(f)
+        else:
+            meta = baseline["meta"]
+            current = run_suite(meta["resolutions"], meta["seconds"], meta["repeat"],
+                                meta["render"] and include_render)
+            if args.output:
+                with open(args.output, "w") as f:
+                    json.dump(current, f, indent=2)
+
+        regressions = compare(baseline, current, args.threshold / 100)
+        if regressions:
+            print("%d regression(s) over %g%%" % (len(regressions), args.threshold))
+            sys.exit(1)
+        print("No regressions over %g%%" % args.threshold)
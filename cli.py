@@ -1,10 +1,15 @@
 import logging
+import multiprocessing
 import os
+import platform
 import shutil
 import secrets
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
-from processor import OsdGenConfig, OsdGenerator, Utils
+from processor import CodecsList, EncoderProbeCache, OsdFont, OsdGenConfig, OsdGenerator, OverlaySink, RenderProfile, Utils
 
 
 def implicit_path(video_path, ext):
@@ -73,6 +78,170 @@ def video_osd_srt_parser(args):
     return args.video_path, osd_paths, srt_paths
 
 
+class BatchScheduler:
+    """
+    Runs the clips of a batch concurrently. Overlay generation is limited
+    by the CPU count and by a memory budget, encoding has its own slots,
+    so one clip can be encoded while the next one is being generated.
+    The font and the probed encoder are shared between all clips.
+    """
+
+    def __init__(self, args, font, generate_slots, encode_slots=1,
+                 memory_budget=None):
+        self.args = args
+        self.font = font
+        self.encoder_name = None
+        self.generate_slots = threading.Semaphore(generate_slots)
+        self.encode_slots = threading.Semaphore(encode_slots)
+        # A clip holds a worker while generating or encoding, more of them
+        # would only wait for a slot
+        self.max_workers = generate_slots + encode_slots
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.memory_cond = threading.Condition()
+        self.encoder_lock = threading.Lock()
+        self.stats = []
+        self.stats_lock = threading.Lock()
+
+    def run(self, configs):
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=min(len(configs), self.max_workers)) as pool:
+            futures = [pool.submit(self._run_clip, config) for config in configs]
+            errors = [f.exception() for f in futures if f.exception()]
+        self._report(time.monotonic() - start)
+        if errors:
+            raise errors[0]
+
+    def _acquire_memory(self, size):
+        if self.memory_budget is None:
+            return
+        with self.memory_cond:
+            # a clip that doesn't fit on its own still runs, just alone
+            self.memory_cond.wait_for(
+                lambda: self.memory_used == 0 or
+                self.memory_used + size <= self.memory_budget)
+            self.memory_used += size
+
+    def _release_memory(self, size):
+        if self.memory_budget is None:
+            return
+        with self.memory_cond:
+            self.memory_used -= size
+            self.memory_cond.notify_all()
+
+    def _get_encoder(self, gen):
+        with self.encoder_lock:
+            if self.encoder_name is None:
+                self.encoder_name = gen.get_encoder()
+        gen.encoder_name = self.encoder_name
+
+    def _run_clip(self, config):
+        args = self.args
+        generate_time = encode_time = 0
+
+        try:
+            if args.stream or args.jobs > 1:
+                with self.generate_slots, self.encode_slots:
+                    gen = OsdGenerator(config, self.font)
+                    memory = gen.estimate_memory()
+                    self._get_encoder(gen)
+                    self._acquire_memory(memory)
+                    try:
+                        start = time.monotonic()
+                        if args.jobs > 1:
+                            gen.render_parallel(args.jobs)
+                        else:
+                            gen.render_stream()
+                        encode_time = time.monotonic() - start
+                    finally:
+                        self._release_memory(memory)
+                        # the PNG folder stays empty when streaming
+                        shutil.rmtree(config.output_path, ignore_errors=True)
+            else:
+                with self.generate_slots:
+                    # The generator opens the video and builds the scaled
+                    # atlas, only once the clip gets to run
+                    gen = OsdGenerator(config, self.font)
+                    memory = gen.estimate_memory()
+                    self._acquire_memory(memory)
+                    try:
+                        start = time.monotonic()
+                        gen.main()
+                        generate_time = time.monotonic() - start
+                    finally:
+                        self._release_memory(memory)
+
+                if not args.no_video:
+                    self._get_encoder(gen)
+                    with self.encode_slots:
+                        try:
+                            start = time.monotonic()
+                            gen.render()
+                            encode_time = time.monotonic() - start
+                        finally:
+                            # will always clean-up PNGs, if flag is specified
+                            if args.remove_png:
+                                shutil.rmtree(config.output_path)
+        except Exception:
+            logging.exception("Processing of %s failed" % config.video_path)
+            raise
+
+        with self.stats_lock:
+            self.stats.append((config.video_path, gen.video.get_total_frames(),
+                               generate_time, encode_time))
+            if config.profiling:
+                print("%s stage timings:\n%s" % (
+                    config.video_path, gen.osdGenStatus.format_stages()))
+
+    def _report(self, wall_time):
+        total = 0
+        for video_path, frames, generate_time, encode_time in self.stats:
+            clip_time = generate_time + encode_time
+            total += frames
+            print("%s: %d frames, overlay %.1fs, encode %.1fs (%.1f fps)" % (
+                video_path, frames, generate_time, encode_time,
+                frames / clip_time if clip_time else 0))
+        print("Batch: %d clips, %d frames in %.1fs (%.1f fps)" % (
+            len(self.stats), total, wall_time,
+            total / wall_time if wall_time else 0))
+
+
+def encoder_cache(command, use_hw):
+    cache = EncoderProbeCache()
+    if command == 'clear':
+        cache.clear()
+        print(f"Removed {cache.path}")
+        return
+
+    if command == 'refresh':
+        codecs = OsdGenerator.load_codecs(True, use_hw)
+        names = [c.name for c in CodecsList(codecs).getbyOS(platform.system().lower())]
+        cache.probe(names, use_hw, refresh=True)
+
+    data = cache.load()
+    print(f"Encoder cache: {cache.path}")
+    for key, results in sorted(data.get("probes", {}).items()):
+        print(key)
+        for name, works in results.items():
+            print(f"    {name:<20} {'ok' if works else 'failed'}")
+
+
+def benchmark_profiles(config, seconds):
+    gen = OsdGenerator(config)
+    try:
+        results = gen.benchmark_profiles(seconds)
+    finally:
+        shutil.rmtree(config.output_path, ignore_errors=True)
+    print(f"{'profile':<20} {'encoder':<12} {'fps':>8} {'size MB':>9} "
+          f"{'Mbit/s':>8} {'PSNR':>7} {'SSIM':>7}")
+    for r in results:
+        psnr = "n/a" if r['psnr'] is None else f"{r['psnr']:.2f}"
+        ssim = "n/a" if r['ssim'] is None else f"{r['ssim']:.4f}"
+        print(f"{r['profile']:<20} {r['encoder']:<12} {r['fps']:>8.1f} "
+              f"{r['size'] / 1024 / 1024:>9.1f} {r['bitrate'] / 1e6:>8.1f} "
+              f"{psnr:>7} {ssim:>7}")
+
+
 if __name__ == '__main__':
 
     parser = ArgumentParser(
@@ -80,7 +249,7 @@ if __name__ == '__main__':
         epilog='Example: python .\cli.py --video-path "video.mp4" --font-path "sneaky_font.png"',
     )
     parser.add_argument('--video-path', help='Path to the video file',
-                        required=True, nargs='+')
+                        nargs='+')
     parser.add_argument('--osd-path', help='Path to the OSD file. If none '
                                            'specified, it will look in the same'
                                            ' directory as the video path',
@@ -89,7 +258,7 @@ if __name__ == '__main__':
                                            'specified, it will look in the same'
                                            ' directory as the video path',
                         nargs='?')
-    parser.add_argument('--font-path', required=True,
+    parser.add_argument('--font-path',
                         help='Path to font file - e.g (INAV_36.png)')
     parser.add_argument('--output-file',
                         help='Output path for PNG folder and finished video')
@@ -118,6 +287,61 @@ if __name__ == '__main__':
                              'Hardware acceleration will be used')
     parser.add_argument('--fast-srt', action='store_true', default=False,
                         help='')
+    parser.add_argument('--sparse-output', action='store_true', default=False,
+                        help='Write one PNG per distinct overlay state plus an '
+                             'ffconcat timeline instead of one PNG per video '
+                             'frame')
+    parser.add_argument('--overlay-sink', default='png',
+                        choices=OverlaySink.NAMES,
+                        help='Format of the generated overlay: PNG sequence, '
+                             'raw bgra stream or alpha video (qtrle, prores '
+                             '4444, vp9)')
+    parser.add_argument('--png-compression', type=int, choices=range(10),
+                        default=None, metavar='[0-9]',
+                        help='zlib level of the overlay PNGs, lower is faster')
+    parser.add_argument('--crop-output', action='store_true', default=False,
+                        help='Only keep the OSD area and the SRT strip in the '
+                             'overlay images instead of full frames')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='Pipe overlay frames straight into ffmpeg and '
+                             'render the video in a single pass, no PNGs are '
+                             'written')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Split each video into this many time ranges and '
+                             'render them in parallel processes, no PNGs are '
+                             'written')
+    parser.add_argument('--batch-jobs', type=int, default=1,
+                        help='Number of clips generating their overlay at the '
+                             'same time, encodes of finished clips overlap '
+                             'with it. Limited by the CPU count')
+    parser.add_argument('--max-memory', type=int, default=None,
+                        help='Memory budget in MB for overlay frames of clips '
+                             'processed at the same time')
+    parser.add_argument('--pipeline-memory', type=int, default=None,
+                        help='Memory budget in MB for overlay frames queued '
+                             'between compositing, encoding and writing of '
+                             'one clip (default 256, 32 with --low-memory)')
+    parser.add_argument('--low-memory', action='store_true', default=False,
+                        help='Small queues and a single PNG encoder thread, '
+                             'for machines with little RAM')
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='Time every pipeline stage and write a JSON '
+                             'report next to each output video')
+    parser.add_argument('--osd-srt', action='store_true', default=False,
+                        help='Render the SRT line with the OSD font as an '
+                             'extra OSD row')
+    parser.add_argument('--render-profile', default=RenderProfile.DEFAULT,
+                        choices=RenderProfile.NAMES,
+                        help='Encoder settings of the rendered video')
+    parser.add_argument('--benchmark-profiles', type=float, nargs='?',
+                        const=10, default=None, metavar='SECONDS',
+                        help='Render the first SECONDS (default 10) of the '
+                             'first video with every render profile, report '
+                             'fps, size and PSNR/SSIM, then exit')
+    parser.add_argument('--encoder-cache', choices=['show', 'refresh', 'clear'],
+                        help='Show, re-probe or delete the cached list of '
+                             'working ffmpeg encoders. Can be used without '
+                             '--video-path')
     parser.add_argument('--no-concat', action='store_true', default=False,
                         help='If multiple files are provided, by default they '
                              'will be concatenated at the end. using this flag'
@@ -125,6 +349,14 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    if args.encoder_cache:
+        encoder_cache(args.encoder_cache, not args.no_hw_accel)
+        if not args.video_path:
+            raise SystemExit(0)
+
+    if not args.video_path or not args.font_path:
+        parser.error('--video-path and --font-path are required')
+
     video, osd, srt = video_osd_srt_parser(args)
 
     png_folders = [default_output_path(x) for x in video]
@@ -135,8 +367,13 @@ if __name__ == '__main__':
         raise ValueError('Multiple videos provided. Please provide '
                          '--output-path')
 
+    if (args.stream or args.jobs > 1) and args.no_video:
+        raise ValueError('--stream and --jobs render the video, they can not '
+                         'be combined with --no-video')
+
+    configs = []
     for video, osd, srt, png_folder in zip(video, osd, srt, png_folders):
-        generator_config = OsdGenConfig(
+        configs.append(OsdGenConfig(
             video_path=video,
             osd_path=osd,
             srt_path=srt,
@@ -149,18 +386,29 @@ if __name__ == '__main__':
             include_srt=args.include_srt,
             hide_sensitive_osd=args.hide_sensitive_osd,
             use_hw=not args.no_hw_accel,
-            fast_srt=args.fast_srt
-        )
+            fast_srt=args.fast_srt,
+            osd_srt=args.osd_srt,
+            sparse_output=args.sparse_output,
+            crop_output=args.crop_output,
+            overlay_sink=args.overlay_sink,
+            png_compression=args.png_compression,
+            render_profile=args.render_profile,
+            memory_budget=args.pipeline_memory * 1024 * 1024 if args.pipeline_memory else None,
+            low_memory=args.low_memory,
+            profiling=args.profile
+        ))
+
+    if args.benchmark_profiles is not None:
+        benchmark_profiles(configs[0], args.benchmark_profiles)
+        raise SystemExit(0)
 
-        gen = OsdGenerator(generator_config)
-        gen.main()
-        if not args.no_video:
-            try:
-                gen.render()
-            finally:
-                # will always clean-up PNGs, if flag is specified
-                if args.remove_png:
-                    shutil.rmtree(png_folder)
+    scheduler = BatchScheduler(
+        args,
+        OsdFont(args.font_path),
+        generate_slots=max(1, min(args.batch_jobs, multiprocessing.cpu_count())),
+        memory_budget=args.max_memory * 1024 * 1024 if args.max_memory else None
+    )
+    scheduler.run(configs)
 
     if not args.no_concat and len(video_outputs) > 1:
         Utils.concatenate_output_files(
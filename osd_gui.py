@@ -1,7 +1,8 @@
 from enum import Enum
 import logging
+import threading
 import wx
-from processor import OSDFile, OsdFont, OsdPreview, VideoFile
+from processor import OSDFile, OsdFont, OsdPreview, OverlaySink, RenderProfile, VideoFile
 import wx.lib.agw.hyperlink as hl
 
 from settings import appState
@@ -156,7 +157,7 @@ class ButtonsPanel(wx.Panel):
         hsizer.AddSpacer(20)
 
         vsizer = wx.BoxSizer(wx.VERTICAL)
-        self.btnStartPng = wx.Button(self, label="Generate PNG sequence only")
+        self.btnStartPng = wx.Button(self, label="Generate overlay only")
         self.btnStartPng.Disable()
         vsizer.Add(self.btnStartPng)
         hsizer.Add(vsizer)
@@ -173,6 +174,24 @@ class ButtonsPanel(wx.Panel):
         self.cbo_upscale = wx.CheckBox(self, label="Upscale video to 1440p")
         vsizer.Add(self.cbo_upscale)
         hsizer.Add(vsizer)
+        hsizer.AddSpacer(20)
+
+        vsizer = wx.BoxSizer(wx.VERTICAL)
+        lbl = wx.StaticText(self, label="Overlay format")
+        vsizer.Add(lbl)
+        self.choice_sink = wx.Choice(self, choices=OverlaySink.NAMES)
+        self.choice_sink.SetSelection(0)
+        vsizer.Add(self.choice_sink)
+        hsizer.Add(vsizer)
+        hsizer.AddSpacer(20)
+
+        vsizer = wx.BoxSizer(wx.VERTICAL)
+        lbl = wx.StaticText(self, label="Render profile")
+        vsizer.Add(lbl)
+        self.choice_profile = wx.Choice(self, choices=RenderProfile.NAMES)
+        self.choice_profile.SetStringSelection(RenderProfile.DEFAULT)
+        vsizer.Add(self.choice_profile)
+        hsizer.Add(vsizer)
         bsizer.Add(hsizer, 0, wx.LEFT)
 
         main_sizer = wx.BoxSizer()
@@ -185,22 +204,36 @@ class ButtonsPanel(wx.Panel):
         self.btnStartPng.Bind(wx.EVT_BUTTON, self.btnStartPngClick)
         self.btnStartVideo.Bind(wx.EVT_BUTTON, self.btnStartVideoClick)
         self.cbo_upscale.Bind(wx.EVT_CHECKBOX, self.chekboxClick)
+        self.choice_sink.Bind(wx.EVT_CHOICE, self.choiceSinkChanged)
+        self.choice_profile.Bind(wx.EVT_CHOICE, self.choiceProfileChanged)
 
     def chekboxClick(self, event):
         appState.render_upscale = bool(self.cbo_upscale.Value)
 
+    def choiceSinkChanged(self, event):
+        appState._overlay_sink = self.choice_sink.GetStringSelection()
+
+    def choiceProfileChanged(self, event):
+        appState._render_profile = self.choice_profile.GetStringSelection()
+
     def eventConfigUpdate(self):
         configured = appState.is_configured()
         self.btnStartPng.Enable(configured)
         self.btnStartVideo.Enable(configured)
 
     def btnStartVideoClick(self, event):
+        # PNGs are only an intermediate here, one per overlay change is enough
+        # and ffmpeg places them, so they don't need the transparent area
+        appState._sparse_output = True
+        appState._crop_output = True
         done = self._render_png()
         if done:
             self._render_video()
             mes = wx.MessageBox("Render done.", "OK")
 
     def btnStartPngClick(self, event):
+        appState._sparse_output = False
+        appState._crop_output = False
         if self._render_png():
             mes = wx.MessageBox(
                 "OSD overlay files are in '%s' directory" % appState._output_path, "OK")
@@ -229,7 +262,9 @@ class ButtonsPanel(wx.Panel):
         keepGoing = True
         while keepGoing and not status.is_complete():
             wx.MilliSleep(200)
-            keepGoing, skip = pd.Update(status.current_frame)
+            stages = status.format_stages()
+            keepGoing, skip = pd.Update(
+                status.current_frame, stages if stages else "Processing frames...")
             if not keepGoing:
                 canceled = True
                 appState.osd_cancel_process()
@@ -281,11 +316,14 @@ class OsdSettingsPanel(wx.Panel):
         btnReset = wx.Button(self, label='Reset')
         self.cbo_srt = wx.CheckBox(self, label="Include SRT data if loaded")
         self.cbo_srt_fast = wx.CheckBox(self, label="Fast SRT render (less pretty font")
+        self.cbo_srt_osd = wx.CheckBox(self, label="Render SRT with OSD font")
         
         self.cbo_hide_data = wx.CheckBox(
             self, label="Hide sensitive OSD values (GPS, Alt, Home dist)")
         self.cbo_use_hw = wx.CheckBox(
             self, label="Use hardware acceleration for video enconding (experimental)")
+        self.cbo_profiling = wx.CheckBox(
+            self, label="Profile processing stages (writes a timing report)")
         btnReset.Bind(wx.EVT_BUTTON, self.btnResetClick)
 
         bsizer.Add(hsizer, 0, wx.LEFT)
@@ -293,10 +331,12 @@ class OsdSettingsPanel(wx.Panel):
         bsizer.AddSpacer(10)
         bsizer.Add(self.cbo_srt, 0, wx.CENTER)
         bsizer.Add(self.cbo_srt_fast, 0, wx.CENTER)
+        bsizer.Add(self.cbo_srt_osd, 0, wx.CENTER)
         bsizer.AddSpacer(10)
         bsizer.Add(self.cbo_hide_data, 0, wx.CENTER)
         bsizer.AddSpacer(10)
         bsizer.Add(self.cbo_use_hw, 0, wx.CENTER)
+        bsizer.Add(self.cbo_profiling, 0, wx.CENTER)
         main_sizer = wx.BoxSizer()
         main_sizer.Add(bsizer, 1, wx.EXPAND | wx.ALL, 10)
         bsizer.AddSpacer(10)
@@ -310,6 +350,8 @@ class OsdSettingsPanel(wx.Panel):
         self.cbo_hide_data.Bind(wx.EVT_CHECKBOX, self.chekboxClick)
         self.cbo_use_hw.Bind(wx.EVT_CHECKBOX, self.chekboxClick)
         self.cbo_srt_fast.Bind(wx.EVT_CHECKBOX, self.chekboxClick)
+        self.cbo_srt_osd.Bind(wx.EVT_CHECKBOX, self.chekboxClick)
+        self.cbo_profiling.Bind(wx.EVT_CHECKBOX, self.chekboxClick)
         
         self.chekboxClick(None)
 
@@ -318,6 +360,8 @@ class OsdSettingsPanel(wx.Panel):
         appState._hide_sensitive_osd = bool(self.cbo_hide_data.Value)
         appState._use_hw = bool(self.cbo_use_hw.Value)
         appState._fast_srt = bool(self.cbo_srt_fast.Value)
+        appState._osd_srt = bool(self.cbo_srt_osd.Value)
+        appState._profiling = bool(self.cbo_profiling.Value)
         pub.sendMessage(PubSubEvents.ConfigUpdate)
 
     def btnResetClick(self, event):
@@ -366,6 +410,66 @@ class BottomPanel(wx.Panel):
         self.SetSizer(main_sizer)
 
 
+class PreviewWorker:
+    """Renders previews off the UI thread, keeping one OsdPreview session alive.
+
+    Only the newest request is kept, so slider events that arrive while a
+    frame is being composed are coalesced into a single render. A play
+    request keeps streaming frames until any other request arrives.
+    """
+
+    def __init__(self, on_ready, on_session, on_play_end):
+        self.on_ready = on_ready
+        self.on_session = on_session
+        self.on_play_end = on_play_end
+        self.session = None
+        self.request = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def submit(self, config, time_ms, osd_pos, osd_zoom, play=False):
+        with self.cond:
+            self.request = (config, time_ms, osd_pos, osd_zoom, play)
+            self.cond.notify()
+
+    def __has_request(self):
+        with self.cond:
+            return self.request is not None
+
+    def __run(self):
+        while True:
+            with self.cond:
+                while self.request is None:
+                    self.cond.wait()
+                config, time_ms, osd_pos, osd_zoom, play = self.request
+                self.request = None
+
+            try:
+                if self.session is None or not self.session.matches(config):
+                    logging.debug("Opening new preview session.")
+                    self.session = OsdPreview(config)
+                    wx.CallAfter(self.on_session, self.session.get_duration())
+
+                if play:
+                    for frame_time, image in self.session.play(time_ms, osd_pos, osd_zoom):
+                        if self.__has_request():
+                            break
+                        wx.CallAfter(self.on_ready, image, frame_time)
+                    else:
+                        wx.CallAfter(self.on_play_end)
+                    continue
+
+                image = self.session.generate_preview_at(time_ms, osd_pos, osd_zoom)
+            except Exception:
+                logging.exception("Preview render failed")
+                self.session = None
+                continue
+
+            if image is not None:
+                wx.CallAfter(self.on_ready, image, time_ms)
+
+
 class PrewievPanel(wx.Panel):
 
     def __init__(self, parent):
@@ -376,10 +480,25 @@ class PrewievPanel(wx.Panel):
         self.imageCtrl = wx.StaticBitmap(self, wx.ID_ANY,
                                          wx.Bitmap(wx.Image(640, 360, True)))
         bsizer.Add(self.imageCtrl, 20, wx.EXPAND | wx.ALL, 20)
+
+        hsizer = wx.BoxSizer()
+        self.btnPlay = wx.ToggleButton(self, label="Play")
+        self.btnPlay.Bind(wx.EVT_TOGGLEBUTTON, self.eventPlayToggled)
+        hsizer.Add(self.btnPlay, 0, wx.ALIGN_CENTER_VERTICAL)
+        hsizer.AddSpacer(10)
+        self.timeSlider = wx.Slider(self, name="Preview time", minValue=0, maxValue=1,
+                                    value=0, style=wx.SL_HORIZONTAL)
+        self.timeSlider.Bind(wx.EVT_SCROLL, self.eventTimeUpdated)
+        hsizer.Add(self.timeSlider, 1, wx.EXPAND)
+        bsizer.Add(hsizer, 0, wx.EXPAND | wx.LEFT | wx.RIGHT | wx.BOTTOM, 20)
+
         main_sizer = wx.BoxSizer()
         main_sizer.Add(bsizer, 0, wx.EXPAND | wx.ALL, 20)
         self.SetSizer(main_sizer)
 
+        self.worker = PreviewWorker(
+            self.onPreviewReady, self.onSessionOpened, self.onPlayEnd)
+
         pub.subscribe(self.eventConfigUpdate, PubSubEvents.ConfigUpdate)
         pub.subscribe(self.eventConfigUpdate, PubSubEvents.PreviewUpdate)
 
@@ -389,10 +508,32 @@ class PrewievPanel(wx.Panel):
         logging.debug("Preview update requested.")
         self.onView()
 
+    def eventTimeUpdated(self, event):
+        if not appState.is_configured():
+            return
+        self.btnPlay.SetValue(False)
+        self.onView()
+
+    def eventPlayToggled(self, event):
+        if not appState.is_configured():
+            self.btnPlay.SetValue(False)
+            return
+        self.onView()
+
     def onView(self):
-        prev = OsdPreview(appState.get_osd_config())
-        image = prev.generate_preview(
-            (appState.offsetLeft, appState.offsetTop), appState.osdZoom)
+        self.worker.submit(appState.get_osd_config(), self.timeSlider.GetValue(),
+                           (appState.offsetLeft, appState.offsetTop), appState.osdZoom,
+                           play=self.btnPlay.GetValue())
+
+    def onSessionOpened(self, duration):
+        self.timeSlider.SetMax(max(duration, 1))
+
+    def onPlayEnd(self):
+        self.btnPlay.SetValue(False)
+
+    def onPreviewReady(self, image, time_ms):
+        if self.btnPlay.GetValue():
+            self.timeSlider.SetValue(time_ms)
         self.imageCtrl.SetBitmap(wx.Bitmap.FromBuffer(640, 360, image))
         self.imageCtrl.Refresh()
         self.Refresh()
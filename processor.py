@@ -1,8 +1,14 @@
+import copy
+import collections
+import contextlib
 import cProfile
-from concurrent.futures import ThreadPoolExecutor
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass, field
 import io
+import json
 import logging
+import math
 import multiprocessing
 import os
 from datetime import datetime
@@ -10,9 +16,12 @@ import platform
 from pstats import SortKey
 import pstats
 import queue
+import re
+import shutil
 from struct import unpack
 import subprocess
-from threading import Thread
+from threading import Condition, Lock, Thread
+import time
 import cv2
 import numpy as np
 import ffmpeg
@@ -35,14 +44,113 @@ class CountsPerSec:
         self._start_time = datetime.now()
         return self
 
-    def increment(self):
-        self._num_occurrences += 1
+    def increment(self, count=1):
+        self._num_occurrences += count
 
     def countsPerSec(self):
         elapsed_time = (datetime.now() - self._start_time).total_seconds()
         return self._num_occurrences / elapsed_time
 
 
+class StageTimer:
+    """
+    Context manager that adds the time spent in its block to a stage of a
+    StageProfiler.
+    """
+
+    def __init__(self, profiler, stage):
+        self.profiler = profiler
+        self.stage = stage
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class StageProfiler:
+    """
+    Per stage timings of a run measured with a monotonic clock. A disabled
+    profiler hands out a shared no-op context manager, so the timers can
+    stay in the hot loops at negligible cost. Stages may be timed from
+    several threads.
+    """
+
+    PERCENTILES = (50, 90, 99)
+    NULL_TIMER = contextlib.nullcontext()
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.samples = {}
+        self.lock = Lock()
+        self.started = time.monotonic()
+
+    def measure(self, stage):
+        if not self.enabled:
+            return self.NULL_TIMER
+        return StageTimer(self, stage)
+
+    def add(self, stage, seconds):
+        if not self.enabled:
+            return
+        samples = self.samples.get(stage)
+        if samples is None:
+            with self.lock:
+                samples = self.samples.setdefault(stage, [])
+        samples.append(seconds)
+
+    def merge(self, samples):
+        """
+        Adds the {stage: [seconds]} samples of another profiler, e.g. one
+        that ran in a worker process.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            for stage, values in samples.items():
+                self.samples.setdefault(stage, []).extend(values)
+
+    def get_summary(self) -> dict:
+        """
+        Returns {stage: {count, total, mean, max, p50, p90, p99}}, times
+        in milliseconds except total which is in seconds.
+        """
+        with self.lock:
+            stages = list(self.samples.items())
+        summary = {}
+        for stage, samples in stages:
+            values = np.array(samples) * 1000
+            if len(values) == 0:
+                continue
+            summary[stage] = {
+                "count": len(values),
+                "total": float(values.sum() / 1000),
+                "mean": float(values.mean()),
+                "max": float(values.max()),
+            }
+            for p, value in zip(self.PERCENTILES, np.percentile(values, self.PERCENTILES)):
+                summary[stage]["p%d" % p] = float(value)
+        return summary
+
+    def format_summary(self):
+        lines = []
+        for stage, s in self.get_summary().items():
+            lines.append("%-14s %7d x  total %7.2fs  p50 %7.3fms  p90 %7.3fms  p99 %7.3fms" % (
+                stage, s["count"], s["total"], s["p50"], s["p90"], s["p99"]))
+        return "\n".join(lines)
+
+    def write_report(self, path, **info):
+        report = dict(info)
+        report["wall_time"] = time.monotonic() - self.started
+        report["stages"] = self.get_summary()
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
 class OsdFont:
 
     GLYPH_HD_H = 18 * 3
@@ -52,20 +160,119 @@ class OsdFont:
 
     def __init__(self, path):
         self.font = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        self.atlas = self.__build_atlas()
+        self.source_atlas = self.atlas
+        self.cell_size = (float(self.atlas.shape[1]), float(self.atlas.shape[2]))
+        self.cell_atlases = {self.get_glyph_size(): self.atlas}
+
+    def __build_atlas(self):
+        # Slice the font strip once into a contiguous (glyphs, h, w, channels)
+        # array, so a whole OSD frame can be assembled with a single gather.
+        if self.is_hd():
+            size_h, size_w = self.GLYPH_HD_H, self.GLYPH_HD_W
+        else:
+            size_h, size_w = self.GLYPH_SD_H, self.GLYPH_SD_W
+        glyph_count = self.font.shape[0] // size_h
+        atlas = self.font[0:glyph_count * size_h, 0:size_w]
+        return np.ascontiguousarray(
+            atlas.reshape(glyph_count, size_h, size_w, self.font.shape[2]))
 
-    def get_glyph(self, index):
-        size_h = self.GLYPH_HD_H if self.is_hd() else self.GLYPH_SD_H
-        size_w = self.GLYPH_HD_W if self.is_hd() else self.GLYPH_SD_W
+    def get_glyph_size(self):
+        return self.atlas.shape[1], self.atlas.shape[2]
 
-        pos_y = size_h * (index)
-        pos_y2 = pos_y + size_h
-        glyph = self.font[pos_y:pos_y2, 0:size_w]
-        
-        if glyph.size > 0:
-            return glyph
+    def scaled(self, scale_x, scale_y):
+        """
+        Returns a copy of the font with the glyphs resampled once to the
+        given scale. Cells are placed at whole pixel multiples of the exact
+        scaled glyph size, so a grid keeps its exact scaled size and single
+        cells are a pixel wider or taller where the truncation falls.
+        """
+        if (scale_x, scale_y) == (1, 1):
+            return self
+
+        font = copy.copy(self)
+        font.cell_size = (self.cell_size[0] * scale_y, self.cell_size[1] * scale_x)
+        font.cell_atlases = {}
+        row_edges, col_edges = font.get_cell_edges(1, 1)
+        font.atlas = font.get_cell_atlas(row_edges[1], col_edges[1])
+        return font
+
+    def get_cell_atlas(self, size_h, size_w):
+        """
+        Returns the atlas with every glyph resampled to size_h x size_w,
+        there are at most four of them per scaled font.
+        """
+        atlas = self.cell_atlases.get((size_h, size_w))
+        if atlas is None:
+            atlas = np.stack([
+                cv2.resize(glyph, (size_w, size_h), interpolation=cv2.INTER_CUBIC)
+                for glyph in self.source_atlas])
+            self.cell_atlases[(size_h, size_w)] = atlas
+        return atlas
+
+    def get_cell_edges(self, rows, cols):
+        """
+        Returns the pixel boundaries of the rows and columns of a grid
+        with rows x cols cells, rows + 1 and cols + 1 of them. Boundaries
+        are truncated like the size of the zoomed OSD always was.
+        """
+        def edges(count, size):
+            positions = np.arange(count + 1)
+            # Cells are at least one pixel, the epsilon absorbs float error
+            return np.maximum(np.floor(positions * size + 1e-6), positions).astype(int)
+
+        cell_h, cell_w = self.cell_size
+        return edges(rows, cell_h), edges(cols, cell_w)
+
+    def get_grid_size(self, rows, cols):
+        """Returns the (height, width) in pixels of a rows x cols grid."""
+        row_edges, col_edges = self.get_cell_edges(rows, cols)
+        return int(row_edges[-1]), int(col_edges[-1])
+
+    def get_glyph_count(self):
+        return self.atlas.shape[0]
+
+    def get_glyph(self, index):
+        if 0 <= index < self.get_glyph_count():
+            return self.atlas[index]
         else:
             return None
 
+    def line_to_glyphs(self, line, width=53):
+        """
+        Maps a text line to a (1, width) row of glyph indices, prefixed with
+        the signal icon and padded with spaces. Chars missing from the font
+        become spaces.
+        """
+        row = np.full((1, width), ord(" "), dtype=np.uint16)
+        codes = [1] + [ord(char) for char in line]
+        codes = [code if code < self.get_glyph_count() else ord(" ") for code in codes]
+        row[0, 1:1 + len(codes)] = codes[:width - 1]
+        return row
+
+    def render_glyphs(self, glyph_grid):
+        """
+        Assemble an OSD image from a (rows, cols) grid of glyph indices.
+        All indices must exist in the font.
+        """
+        rows, cols = glyph_grid.shape
+        row_edges, col_edges = self.get_cell_edges(rows, cols)
+        heights, widths = np.diff(row_edges), np.diff(col_edges)
+        channels = self.atlas.shape[3]
+        if np.all(heights == heights[0]) and np.all(widths == widths[0]):
+            glyphs = self.get_cell_atlas(heights[0], widths[0])[glyph_grid]
+            return glyphs.transpose(0, 2, 1, 3, 4).reshape(
+                row_edges[-1], col_edges[-1], channels)
+
+        # Cells differ by a pixel at fractional scales, copy them one by one
+        image = np.empty((row_edges[-1], col_edges[-1], channels), dtype=self.atlas.dtype)
+        for row in range(rows):
+            y1, y2 = row_edges[row], row_edges[row + 1]
+            for col in range(cols):
+                x1, x2 = col_edges[col], col_edges[col + 1]
+                image[y1:y2, x1:x2] = self.get_cell_atlas(y2 - y1, x2 - x1)[glyph_grid[row, col]]
+        return image
+
     def is_hd(self):
         font_w = self.font.shape[1]
         return font_w == self.GLYPH_HD_W
@@ -82,27 +289,44 @@ class OSDFile:
     READ_SIZE = 2124
 
     def __init__(self, path, font: OsdFont):
-        self.osdFile = open(path, "rb")
-        self.fcType = self.osdFile.read(4).decode("utf-8")
-        self.magic = self.osdFile.read(36)
+        self.records = OSDRecords(path)
+        self.fcType = self.records.fcType
+        self.magic = self.records.magic
         self.font = font
+        self.index = 0
+        self.missing_glyphs = set()
+        if font is not None:
+            self.__report_missing_glyphs()
 
     def peek_frame(self, frame_no):
-        frame_start = frame_no * self.READ_SIZE
-        current_pos = self.osdFile.tell()
-        self.osdFile.seek(frame_start)
-        frame = self.read_frame()
-        self.osdFile.seek(current_pos)
+        if not 0 <= frame_no < len(self.records):
+            return False
 
-        return frame
+        return self.records.get_frame(frame_no, self.font)
 
     def read_frame(self):
+        frame = self.peek_frame(self.index)
+        if frame:
+            self.index += 1
 
-        rawData = self.osdFile.read(self.READ_SIZE)
-        if len(rawData) < self.READ_SIZE:
-            return False
+        return frame
+
+    def seek(self, frame_no):
+        self.index = frame_no
+
+    def tell(self):
+        return self.index
 
-        return Frame(rawData, self.font)
+    def __report_missing_glyphs(self):
+        glyph_codes = self.records.glyph_codes
+        glyph_count = self.font.get_glyph_count()
+        if len(glyph_codes) == 0 or glyph_codes.max() < glyph_count:
+            return
+
+        self.missing_glyphs = set(
+            np.unique(glyph_codes[glyph_codes >= glyph_count]).tolist())
+        for glyph_index in sorted(self.missing_glyphs):
+            logging.info("Issue with OSD file, glyph index %s doesnt exist in given font! Replacing with empty char." % glyph_index)
 
     def get_software_name(self):
         mapping = {
@@ -115,85 +339,199 @@ class OSDFile:
 
 @dataclass
 class MaskObject:
+    """
+    Masks the cells first..last (inclusive, relative to the anchor symbol,
+    negative is before it) around every occurrence of the anchor glyph.
+    """
     name: str
     index: int
-    length: int
-    pos: int = -1
+    first: int
+    last: int
+
+
+class SensitiveMask:
+    """
+    Hides GPS position, home distance and altitude in OSD glyph grids.
+    The rules of a firmware are compiled once into an anchor lookup table
+    and a padded table of cell offsets, masking a frame is then a few
+    NumPy operations on the flattened grid.
+    """
+
+    MASK_GLYPH = ord("*")
+    RULES = {
+        # INAV symbol codes, the windows match the masking of older versions,
+        # which let them run on into the neighbouring row
+        "INAV": [
+            MaskObject("lat", 3, 1, 5),
+            MaskObject("lon", 4, 1, 5),
+            MaskObject("home", 16, 1, 2),
+            MaskObject("altitude", 118, -4, -2),
+        ],
+        # Betaflight: symbol followed by the value
+        "BTFL": [
+            MaskObject("lat", 0x89, 1, 11),
+            MaskObject("lon", 0x98, 1, 11),
+            MaskObject("home", 0x11, 1, 5),
+            MaskObject("altitude", 0x7F, 1, 5),
+        ],
+        # Ardupilot: altitude value is in front of its unit symbol
+        "ARDU": [
+            MaskObject("lat", 0xA6, 1, 12),
+            MaskObject("lon", 0xA7, 1, 12),
+            MaskObject("home", 0xBF, 1, 7),
+            MaskObject("altitude_m", 0xB1, -4, -1),
+            MaskObject("altitude_ft", 0xB3, -4, -1),
+        ],
+    }
+    # Recordings of other firmwares used to be masked with the INAV rules
+    DEFAULT_FIRMWARE = "INAV"
+
+    def __init__(self, rules):
+        # One extra entry without a rule, codes above the table map to it
+        table_size = max(rule.index for rule in rules) + 2
+        width = max(rule.last - rule.first + 1 for rule in rules)
+
+        self.anchors = np.full(table_size, -1, dtype=np.int16)
+        self.offsets = np.zeros((len(rules), width), dtype=np.int64)
+        self.valid = np.zeros((len(rules), width), dtype=bool)
+        for i, rule in enumerate(rules):
+            count = rule.last - rule.first + 1
+            self.anchors[rule.index] = i
+            self.offsets[i, :count] = np.arange(rule.first, rule.last + 1)
+            self.valid[i, :count] = True
 
-    def __eq__(self, other: int):
-        return self.index == other
+    @staticmethod
+    def for_firmware(fc_type):
+        if fc_type not in SensitiveMask.RULES:
+            fc_type = SensitiveMask.DEFAULT_FIRMWARE
+        return SensitiveMask.compile(fc_type)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def compile(fc_type):
+        return SensitiveMask(SensitiveMask.RULES[fc_type])
+
+    def apply(self, glyph_codes):
+        """
+        Returns a masked copy of glyph_codes, or glyph_codes itself when
+        there is nothing to hide.
+        """
+        codes = glyph_codes.reshape(-1)
+        rule_ids = self.anchors[np.minimum(codes, len(self.anchors) - 1)]
+        positions = np.flatnonzero(rule_ids >= 0)
+        if len(positions) == 0:
+            return glyph_codes
+
+        # Windows are clipped to the row of their anchor, values next to
+        # the right or left edge don't continue on the neighbouring row
+        rule_ids = rule_ids[positions]
+        offsets = self.offsets[rule_ids]
+        columns = positions[:, np.newaxis] % glyph_codes.shape[-1] + offsets
+        valid = self.valid[rule_ids] & (columns >= 0) & (columns < glyph_codes.shape[-1])
+        targets = positions[:, np.newaxis] + offsets
+
+        masked = codes.copy()
+        masked[targets[valid]] = self.MASK_GLYPH
+        return masked.reshape(glyph_codes.shape)
 
 
 class Frame:
     frame_w = 53
     frame_h = 20
 
-    def __init__(self, data, font: OsdFont):
+    def __init__(self, data, font: OsdFont, mask: SensitiveMask = None):
         raw_time = data[0:4]
         self.startTime = unpack("<L", raw_time)[0]
         self.rawData = data[4:]
+        self.glyph_codes = np.frombuffer(
+            self.rawData, dtype="<u2").reshape(self.frame_h, self.frame_w)
         self.font = font
-        
-        self.inav_mask_list = [
-            MaskObject("lat", 3, 6),
-            MaskObject("lon", 4, 6),
-            MaskObject("home", 16, 3),
-            MaskObject("altitude", 118, -4),
-        ]
-        
-        self.mask_glyph = self.font.get_glyph(ord("*"))
-        
-    def __convert_to_glyphs(self, hide):
-        glyphs_arr = []
-        glyph_no = []
-        to_mask = []
-           
-        for x in range(0, len(self.rawData), 2):
-            index, page = unpack("<BB", self.rawData[x:x + 2])
-            glyph_index = index + page * 256
-
-            glyph = self.font.get_glyph(glyph_index)
-            if glyph is not None:
-                glyph_no.append(glyph_index)
-                glyphs_arr.append(glyph)
-            else:
-                logging.info("Issue with OSD file, glyph index %s doesnt exist in given font! Replacing with empty char." % glyph_index)
-                glyph_no.append(glyph_index)
-                glyphs_arr.append(self.font.get_glyph(ord(" ")))
-                
-            if hide and glyph_index in self.inav_mask_list:  
-                
-                mask_me = self.inav_mask_list[self.inav_mask_list.index(glyph_index)]
-                mask_me.pos = len(glyphs_arr) - 1
-                to_mask.append(mask_me)
-
-        for item in to_mask:
-            if item.length > 0:
-                mask_from = item.pos + 1
-                mask_to = item.pos + item.length
-            else:
-                mask_from = item.pos + item.length
-                mask_to = item.pos - 1
-                
-            for mask_pos in range(mask_from, mask_to):
-                glyphs_arr[mask_pos] = self.mask_glyph
-        
-        # logging.debug("Frame data: %s" % glyph_no)
-        
-        return glyphs_arr
+        self.mask = mask if mask is not None else SensitiveMask.for_firmware(
+            SensitiveMask.DEFAULT_FIRMWARE)
 
     def get_osd_frame_glyphs(self, hide):
-        glyphs = self.__convert_to_glyphs(hide)
-        osd_frame = []
+        """
+        Returns the (frame_h, frame_w) grid of glyph indices for this frame,
+        with indices missing from the font replaced by an empty char.
+        """
+        glyph_codes = self.glyph_codes
+        if glyph_codes.max() >= self.font.get_glyph_count():
+            glyph_codes = np.where(
+                glyph_codes < self.font.get_glyph_count(), glyph_codes, ord(" "))
+
+        if hide:
+            glyph_codes = self.mask.apply(glyph_codes)
+
+        return glyph_codes
+
+
+class OSDRecords:
+    """
+    Read-only, memory-mapped view of all records in an OSD file.
+    Reads don't share a cursor, so one instance can be used from several
+    threads, and it can be pickled to worker processes (the file is mapped
+    again on the other side).
+    """
+
+    HEADER_SIZE = 40
+    RECORD_DTYPE = np.dtype([
+        ("startTime", "<u4"),
+        ("glyphs", "<u2", (Frame.frame_h, Frame.frame_w)),
+    ])
+
+    def __init__(self, path):
+        self.path = path
+        self.__open()
+
+    def __open(self):
+        with open(self.path, "rb") as f:
+            header = f.read(self.HEADER_SIZE)
+        self.fcType = header[0:4].decode("utf-8")
+        self.magic = header[4:self.HEADER_SIZE]
+
+        record_size = self.RECORD_DTYPE.itemsize
+        count = max(0, os.path.getsize(self.path) - self.HEADER_SIZE) // record_size
+        if count > 0:
+            self.raw = np.memmap(self.path, dtype=np.uint8, mode="r",
+                                 offset=self.HEADER_SIZE, shape=(count, record_size))
+        else:
+            self.raw = np.zeros((0, record_size), dtype=np.uint8)
+        self.records = self.raw.view(self.RECORD_DTYPE).reshape(count)
+        self.mask = SensitiveMask.for_firmware(self.fcType)
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.__open()
 
-        gi = 0
-        for y in range(self.frame_h):
-            frame_line = []
-            for x in range(self.frame_w):
-                frame_line.append(glyphs[gi])
-                gi += 1
-            osd_frame.append(frame_line)
-        return osd_frame
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, key):
+        return self.records[key]
+
+    @property
+    def timestamps(self):
+        return self.records["startTime"]
+
+    @property
+    def glyph_codes(self):
+        return self.records["glyphs"]
+
+    def get_frame(self, index, font: OsdFont):
+        return Frame(self.raw[index], font, self.mask)
+
+    def get_change_ids(self):
+        """
+        Returns an id per record that only increases when its glyph codes
+        differ from the previous record, equal ids mean identical frames.
+        """
+        codes = self.glyph_codes.reshape(len(self), -1)
+        changed = np.ones(len(self), dtype=bool)
+        changed[1:] = np.any(codes[1:] != codes[:-1], axis=1)
+        return np.cumsum(changed)
 
 
 class VideoFrame:
@@ -204,6 +542,9 @@ class VideoFrame:
 
 class VideoFile:
 
+    # Decoding forward is cheaper than a keyframe seek for short jumps
+    MAX_FORWARD_DECODE = 30
+
     def __init__(self, path):
         self.videoFile = cv2.VideoCapture(path)
 
@@ -237,9 +578,32 @@ class VideoFile:
 
         return VideoFrame(frame)
 
+    def tell(self):
+        return int(self.videoFile.get(cv2.CAP_PROP_POS_FRAMES))
+
+    def seek(self, frame_index):
+        """
+        Positions the decoder so that the next read returns frame_index
+        (0 based). Short forward jumps are decoded through, anything else
+        seeks to the preceding keyframe and decodes forward from there.
+        """
+        skip = frame_index - self.tell()
+        if 0 <= skip <= self.MAX_FORWARD_DECODE:
+            for _ in range(skip):
+                self.videoFile.grab()
+        else:
+            self.videoFile.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+
+    def skip_frame(self):
+        return self.videoFile.grab()
+
+    def read_frame_at(self, frame_index):
+        self.seek(frame_index)
+        return self.read_frame()
+
 
 class OsdGenConfig:
-    def __init__(self, video_path, osd_path, font_path, srt_path, output_path, offset_left, offset_top, osd_zoom, render_upscale, include_srt, hide_sensitive_osd, use_hw, fast_srt) -> None:
+    def __init__(self, video_path, osd_path, font_path, srt_path, output_path, offset_left, offset_top, osd_zoom, render_upscale, include_srt, hide_sensitive_osd, use_hw, fast_srt, sparse_output=False, crop_output=False, overlay_sink="png", png_compression=None, osd_srt=False, render_profile="archive-lossless", memory_budget=None, low_memory=False, profiling=False) -> None:
         self.video_path = video_path
         self.osd_path = osd_path
         self.font_path = font_path
@@ -253,13 +617,104 @@ class OsdGenConfig:
         self.hide_sensitive_osd = hide_sensitive_osd
         self.use_hw = use_hw
         self.fast_srt = fast_srt
+        self.sparse_output = sparse_output
+        self.crop_output = crop_output
+        self.overlay_sink = overlay_sink
+        self.png_compression = png_compression
+        self.osd_srt = osd_srt
+        self.render_profile = render_profile
+        self.memory_budget = memory_budget
+        self.low_memory = low_memory
+        self.profiling = profiling
+
+
+class OverlayManifest:
+    """
+    Timeline of a sparse overlay sequence, one image per distinct overlay
+    state. Written as an ffconcat file, so ffmpeg shows every image for
+    the exact number of video frames it covers.
+    """
+
+    FILE_NAME = "overlay.ffconcat"
+
+    def __init__(self, fps):
+        self.fps = fps
+        self.entries = []
+
+    def add(self, file_name, frame_no):
+        self.entries.append((file_name, frame_no))
+
+    def get_start_us(self, frame_no):
+        """
+        Start of the video frame in whole microseconds, never after it.
+        """
+        return math.floor((frame_no - 1) * 1000000 / self.fps)
+
+    def write(self, path, end_frame_no):
+        with open(path, "w") as fp:
+            fp.write("ffconcat version 1.0\n")
+            ends = [frame_no for _, frame_no in self.entries[1:]] + [end_frame_no]
+            for (file_name, frame_no), end in zip(self.entries, ends):
+                # The concat demuxer adds the durations up, differences of
+                # whole microsecond starts keep every entry frame exact.
+                duration = self.get_start_us(end) - self.get_start_us(frame_no)
+                fp.write(f"file '{file_name}'\n")
+                fp.write(f"duration {duration // 1000000}.{duration % 1000000:06d}\n")
+            if self.entries:
+                # The concat demuxer ignores the duration of the last entry
+                # unless the file is listed once more.
+                fp.write(f"file '{self.entries[-1][0]}'\n")
+
+
+class OverlayTimeline:
+    """
+    Maps every output video frame to the OSD record and SRT record shown on
+    it, computed up front with np.searchsorted. A frame shows the first
+    record that starts at or after the frame time, the timeline ends
+    where the OSD recording ends.
+    """
+
+    def __init__(self, video_fps, start_frame, end_frame, osd_times, osd_ids,
+                 srt_times=None, srt_ids=None):
+        frames = np.arange(start_frame, max(start_frame, end_frame))
+        frames_per_ms = 1 / video_fps * 1000
+        video_times = ((frames - 1) * frames_per_ms).astype(np.int64)
+
+        # Timestamps have to be sorted for searchsorted, ignore glitches
+        # where the recorder clock went backwards.
+        osd_times = np.maximum.accumulate(osd_times) if len(osd_times) else osd_times
+        osd_index = np.searchsorted(osd_times, video_times, side="left")
+        count = int(np.count_nonzero(osd_index < len(osd_times)))
+
+        self.frames = frames[:count]
+        self.osd_index = osd_index[:count]
+        state = [osd_ids[self.osd_index]]
+
+        if srt_times is not None and len(srt_times):
+            srt_index = np.searchsorted(srt_times, video_times[:count], side="left")
+            self.srt_index = np.minimum(srt_index, len(srt_times) - 1)
+            state.append(srt_ids[self.srt_index])
+        else:
+            self.srt_index = None
+
+        self.changed = np.ones(count, dtype=bool)
+        if count > 1:
+            self.changed[1:] = np.any(
+                [s[1:] != s[:-1] for s in state], axis=0)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get_deduplicated_count(self):
+        return int(len(self.changed) - np.count_nonzero(self.changed))
 
 
 class OsdGenStatus:
-    def __init__(self) -> None:
+    def __init__(self, profiler: StageProfiler = None) -> None:
         self.current_frame = -1
         self.total_frames = -1
         self.fps = -1
+        self.profiler = profiler if profiler is not None else StageProfiler()
 
     def update(self, current, total, fps) -> None:
         self.current_frame = current
@@ -269,32 +724,15 @@ class OsdGenStatus:
     def is_complete(self) -> bool:
         return self.current_frame >= self.total_frames
 
+    def get_stages(self) -> dict:
+        """Live per stage timings, empty unless profiling is enabled."""
+        return self.profiler.get_summary()
 
-class Utils:
-
-    @staticmethod
-    def merge_images(img, overlay, x, y, zoom):
-        scale_percent = zoom  # percent of original size
-        width = int(overlay.shape[1] * scale_percent / 100)
-        height = int(overlay.shape[0] * scale_percent / 100)
-        dim = (width, height)
-        img_overlay_res = cv2.resize(
-            overlay, dim, interpolation=cv2.INTER_CUBIC)
-        # img_crop = img_overlay_res[y:img.shape[0],x:img.shape[1]]
-
-        # Image ranges
-        y1, y2 = max(0, y), min(img.shape[0], y + img_overlay_res.shape[0])
-        x1, x2 = max(0, x), min(img.shape[1], x + img_overlay_res.shape[1])
-        # Overlay ranges
-        y1o, y2o = max(0, -y), min(img_overlay_res.shape[0], img.shape[0] - y)
-        x1o, x2o = max(0, -x), min(img_overlay_res.shape[1], img.shape[1] - x)
+    def format_stages(self) -> str:
+        return self.profiler.format_summary()
 
-        img_crop = img[y1:y2, x1:x2]
-        img_overlay_crop = img_overlay_res[y1o:y2o, x1o:x2o]
 
-        img_crop[:] = img_overlay_crop + img_crop
-        img = img_crop
-        # img[y:y+img_crop.shape[0], x:x+img_crop.shape[1]] = img_crop
+class Utils:
 
     @staticmethod
     def overlay_image_alpha(img, img_overlay, x, y, zoom):
@@ -329,6 +767,41 @@ class Utils:
 
         img_crop[:] = alpha * img_overlay_crop + alpha_inv * img_crop
 
+    @staticmethod
+    def blend_over(dst, src):
+        """
+        Blends a straight alpha BGRA src over dst (BGR or BGRA) of the same
+        size in place, pixels where src is fully transparent are untouched.
+        """
+        src = src.astype(np.float32, copy=False)
+        alpha = src[:, :, 3:4] / 255
+        base = dst.astype(np.float32)
+        if dst.shape[2] == 3:
+            blended = src[:, :, :3] * alpha + base * (1 - alpha)
+        else:
+            # Straight alpha "over", the overlay itself is transparent
+            base_alpha = base[:, :, 3:4] / 255 * (1 - alpha)
+            out_alpha = alpha + base_alpha
+            color = (src[:, :, :3] * alpha + base[:, :, :3] * base_alpha) / np.maximum(out_alpha, 1e-6)
+            blended = np.concatenate([color, out_alpha * 255], axis=2)
+
+        covered = src[:, :, 3] > 0
+        dst[covered] = np.rint(blended[covered]).astype(np.uint8)
+
+    @staticmethod
+    def overlay_srt_line_glyphs(img, font, line, left_offset):
+        """
+        Draws the line as an extra row of OSD glyphs at the bottom of img,
+        in place.
+        """
+        row = font.render_glyphs(font.line_to_glyphs(line))
+        y = img.shape[0] - row.shape[0] - 15
+        x1, x2 = max(0, left_offset), min(img.shape[1], left_offset + row.shape[1])
+        y1, y2 = max(0, y), img.shape[0] - 15
+        if x1 < x2 and y1 < y2:
+            Utils.blend_over(img[y1:y2, x1:x2], row[y1 - y:, x1 - left_offset:x2 - left_offset])
+        return img
+
     @staticmethod
     def overlay_srt_line(fast, img, line, font_size, left_offset):
         if fast:
@@ -338,18 +811,7 @@ class Utils:
 
     @staticmethod
     def overlay_srt_line_slow(img, line, font_size, left_offset):
-        pos_calc = (left_offset, img.shape[0] - 15)
-        pil_im = Image.fromarray(img)
-        draw = ImageDraw.Draw(pil_im, 'RGBA')
-        try:
-            font = ImageFont.truetype("font.ttf", font_size)
-        except OSError:
-            folder, _ = os.path.split(__file__)
-            font = ImageFont.truetype(f"{folder}/resources/font.ttf")
-
-        draw.text(pos_calc, line, font=font, fill=(
-            255, 255, 255, 255), anchor="lb")
-        return Utils.to_numpy(pil_im)
+        return SrtTextRenderer.get(font_size, left_offset).overlay(img, line)
 
         # pos_calc = (20, img.shape[0] - 30)
         # cv2.putText(img, line, pos_calc, cv2.FONT_ITALIC, 1/10 * font_size, (255, 255, 255, 255), 1)
@@ -358,31 +820,39 @@ class Utils:
         
     @staticmethod
     def overlay_srt_line_fast(img, line, font_size, left_offset):
-        left_offset = 200 if img.shape[1] > 1300 else 100 
         pos_calc = (left_offset, img.shape[0] - 30)
         cv2.putText(img, line, pos_calc, cv2.FONT_HERSHEY_COMPLEX, 1/40 * font_size, (255, 255, 255, 255), 1)
 
         return img
+
     @staticmethod
-    def to_numpy(im):
-        im.load()
-        # unpack data
-        e = Image._getencoder(im.mode, 'raw', im.mode)
-        e.setimage(im.im)
-
-        # NumPy buffer for the result
-        shape, typestr = Image._conv_type_shape(im)
-        data = np.empty(shape, dtype=np.dtype(typestr))
-        mem = data.data.cast('B', (data.data.nbytes,))
-
-        bufsize, s, offset = 65536, 0, 0
-        while not s:
-            l, s, d = e.encode(bufsize)
-            mem[offset:offset + len(d)] = d
-            offset += len(d)
-        if s < 0:
-            raise RuntimeError("encoder error %d in tobytes" % s)
-        return data
+    def wait_process(process):
+        """
+        Waits for an ffmpeg process started with run_async and raises
+        ffmpeg.Error, like run() does, when it failed.
+        """
+        if process.wait() != 0:
+            raise ffmpeg.Error("ffmpeg", None, None)
+
+    @staticmethod
+    def compare_videos(path, reference_path):
+        """
+        Returns (psnr, ssim) of the video at path against reference_path,
+        None for a metric ffmpeg did not report.
+        """
+        dist = ffmpeg.input(path).video.split()
+        ref = ffmpeg.input(reference_path).video.split()
+        _, err = (
+            ffmpeg
+            .output(ffmpeg.filter([dist[0], ref[0]], "psnr"),
+                    ffmpeg.filter([dist[1], ref[1]], "ssim"), "-", format="null")
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+        err = err.decode(errors="replace")
+        psnr = re.search(r"PSNR .*average:(\S+)", err)
+        ssim = re.search(r"SSIM .*All:(\S+)", err)
+        return (float(psnr.group(1)) if psnr else None,
+                float(ssim.group(1)) if ssim else None)
 
     @staticmethod
     def concatenate_output_files(output_files: list, final_path: str) -> None:
@@ -405,12 +875,146 @@ class Utils:
         except subprocess.CalledProcessError as exc:
             print(exc.output.decode())
             print(exc.returncode)
+            raise
         finally:
             os.remove('file_list.txt')
 
 
+class SrtTextRenderer:
+    """
+    Draws SRT lines with the TrueType font. Every distinct line is rendered
+    once into a small RGBA strip kept in an LRU cache, and only the bottom
+    band of the image is blended with it.
+    """
+
+    def __init__(self, font_size, left_offset, cache_size=256):
+        self.font = self.load_font(font_size)
+        self.left_offset = left_offset
+        ascent, _ = self.font.getmetrics()
+        # Text baseline sits 15px above the bottom edge
+        self.baseline = 15
+        self.strip_height = ascent + self.baseline
+        self.render_strip = functools.lru_cache(maxsize=cache_size)(self.__render_strip)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=8)
+    def get(font_size, left_offset):
+        return SrtTextRenderer(font_size, left_offset)
+
+    @staticmethod
+    def load_font(font_size):
+        try:
+            return ImageFont.truetype("font.ttf", font_size)
+        except OSError:
+            folder, _ = os.path.split(__file__)
+            return ImageFont.truetype(f"{folder}/resources/font.ttf", font_size)
+
+    def __render_strip(self, line, width):
+        strip = Image.new("RGBA", (width, self.strip_height), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(strip, "RGBA")
+        draw.text((self.left_offset, self.strip_height - self.baseline), line,
+                  font=self.font, fill=(255, 255, 255, 255), anchor="lb")
+        strip = np.asarray(strip)
+
+        # Keep only the area the text covers
+        ys, xs = np.nonzero(strip[:, :, 3])
+        if len(ys) == 0:
+            return None, 0, 0
+        y1, x1 = ys.min(), xs.min()
+        text = strip[y1:ys.max() + 1, x1:xs.max() + 1].astype(np.float32)
+        text.setflags(write=False)
+        return text, int(y1), int(x1)
+
+    def overlay(self, img, line):
+        """
+        Blends the line into the bottom of img in place and returns img.
+        """
+        text, y, x = self.render_strip(line, img.shape[1])
+        if text is None:
+            return img
+
+        top = img.shape[0] - self.strip_height + y
+        y1, y2 = max(0, top), min(img.shape[0], top + text.shape[0])
+        if y1 >= y2:
+            return img
+        text = text[y1 - top:y2 - top]
+        dst = img[y1:y2, x:x + text.shape[1]]
+        text = text[:, :dst.shape[1]]
+
+        Utils.blend_over(dst, text)
+        return img
+
+
+class OsdCompositor:
+    """
+    Composites OSD glyph grids onto a persistent, full size overlay canvas.
+    The previous grid is kept, so only cells whose glyph changed are
+    blitted again and copied into the canvas. Zoom is expected to be
+    baked into the font already, see OsdFont.scaled.
+    """
+
+    def __init__(self, font: OsdFont, canvas_size, offset_left, offset_top):
+        self.font = font
+        self.offset_left = offset_left
+        self.offset_top = offset_top
+        self.row_edges = self.col_edges = None
+        self.canvas = np.zeros(
+            (canvas_size[0], canvas_size[1], font.atlas.shape[3]), dtype=np.uint8)
+        self.osd_image = None
+        self.glyph_grid = None
+
+    def compose(self, glyph_grid):
+        """
+        Updates the canvas with the given glyph grid and returns it. The
+        canvas is reused by the next call, copy it to keep it.
+        """
+        if self.glyph_grid is None or self.glyph_grid.shape != glyph_grid.shape:
+            self.osd_image = self.font.render_glyphs(glyph_grid)
+            self.glyph_grid = glyph_grid.copy()
+            self.row_edges, self.col_edges = self.font.get_cell_edges(*glyph_grid.shape)
+            self.__draw(None)
+            return self.canvas
+
+        rows, cols = np.nonzero(glyph_grid != self.glyph_grid)
+        if len(rows) == 0:
+            return self.canvas
+
+        self.glyph_grid[rows, cols] = glyph_grid[rows, cols]
+        self.__draw(zip(rows, cols))
+
+        return self.canvas
+
+    def __draw(self, dirty_cells):
+        img, osd = self.canvas, self.osd_image
+        x, y = self.offset_left, self.offset_top
+        y1, y2 = max(0, y), min(img.shape[0], y + osd.shape[0])
+        x1, x2 = max(0, x), min(img.shape[1], x + osd.shape[1])
+        if y1 >= y2 or x1 >= x2:
+            return
+        img_crop = img[y1:y2, x1:x2]
+        osd_crop = osd[y1 - y:y2 - y, x1 - x:x2 - x]
+
+        if dirty_cells is None:
+            img_crop[:] = osd_crop
+            return
+
+        crop_h, crop_w = img_crop.shape[:2]
+        for row, col in dirty_cells:
+            oy1, oy2 = self.row_edges[row], self.row_edges[row + 1]
+            ox1, ox2 = self.col_edges[col], self.col_edges[col + 1]
+            osd[oy1:oy2, ox1:ox2] = self.font.get_cell_atlas(
+                oy2 - oy1, ox2 - ox1)[self.glyph_grid[row, col]]
+            cy1, cy2 = max(0, oy1 + y - y1), min(crop_h, oy2 + y - y1)
+            cx1, cx2 = max(0, ox1 + x - x1), min(crop_w, ox2 + x - x1)
+            if cy1 < cy2 and cx1 < cx2:
+                img_crop[cy1:cy2, cx1:cx2] = osd_crop[cy1:cy2, cx1:cx2]
+
+
 class OsdPreview:
 
+    PREVIEW_SIZE = (640, 360)
+    FRAME_CACHE_SIZE = 128
+
     def __init__(self, config: OsdGenConfig):
         self.stopped = False
 
@@ -424,73 +1028,788 @@ class OsdPreview:
         self.output = config.output_path
         self.config = config
 
+        # Everything is composed at preview resolution, offsets and zoom
+        # are scaled from video pixels.
+        video_h, video_w = self.video.get_size()
+        self.preview_scale = (self.PREVIEW_SIZE[0] / max(video_w, 1),
+                              self.PREVIEW_SIZE[1] / max(video_h, 1))
+
+        self.timeline = None
+        self.get_scaled_font = functools.lru_cache(maxsize=8)(self.__scale_font)
+        self.get_video_frame = functools.lru_cache(
+            maxsize=self.FRAME_CACHE_SIZE)(self.__decode_video_frame)
+        self.get_osd_glyphs = functools.lru_cache(maxsize=256)(self.__read_osd_glyphs)
+
     def str_line_to_glyphs(self, line):
-        filler = self.font.get_glyph(32)
-        rssi = self.font.get_glyph(1)
-        glyphs = [filler, rssi]
-        for char in line:
-            gi = ord(char)
-            g = self.font.get_glyph(gi)
-            glyphs.append(g)
+        return self.font.line_to_glyphs(line)
 
-        for x in range(len(glyphs), 53):
-            glyphs.append(filler)
+    def matches(self, config: OsdGenConfig):
+        """True when the cached inputs are still valid for config."""
+        keys = ("video_path", "osd_path", "font_path", "srt_path",
+                "hide_sensitive_osd", "include_srt", "fast_srt", "osd_srt")
+        return all(getattr(self.config, key) == getattr(config, key) for key in keys)
 
-        return glyphs[:53]
+    def __scale_font(self, osd_zomm):
+        # The generator's cells are glyph * upscale * zoom output pixels, the
+        # upscale cancels out at preview scale. Cells are placed the same
+        # way too, so the OSD is the output OSD scaled to the preview.
+        scale_x, scale_y = self.preview_scale
+        return self.font.scaled(scale_x * osd_zomm / 100, scale_y * osd_zomm / 100)
 
-    def generate_preview(self, osd_pos, osd_zomm):
+    def __downsample(self, video_frame):
+        return cv2.resize(video_frame, self.PREVIEW_SIZE, interpolation=cv2.INTER_AREA)
 
-        video_frame = self.video.read_frame().data
+    def get_fps(self):
+        return self.video.get_fps()
 
-        for skipme in range(20):
-            self.osd.read_frame()
-            if self.srt:
-                srt_data = self.srt.next_data()
+    def get_duration(self):
+        """Length of the part of the video covered by the OSD, in ms."""
+        timeline = self.__get_timeline()
+        if len(timeline) == 0:
+            return 0
+        return int((timeline.frames[-1] - 1) * 1000 / self.get_fps())
 
-        osd_frame_glyphs = self.osd.read_frame().get_osd_frame_glyphs(
-            hide=self.config.hide_sensitive_osd)
+    def get_frame_no(self, time_ms):
+        timeline = self.__get_timeline()
+        frame_no = int(round(time_ms * self.get_fps() / 1000)) + 1
+        return min(max(frame_no, 1), max(len(timeline), 1))
 
-        osd_frame = cv2.vconcat([cv2.hconcat(im_list_h)
-                                for im_list_h in osd_frame_glyphs])
-        if self.srt and self.config.include_srt:
-            srt_line = srt_data["line"]
-            video_frame = Utils.overlay_srt_line(
-                self.config.fast_srt, video_frame, srt_line, self.font.get_srt_font_size(), (150 if self.font.is_hd() else 100))
-        Utils.overlay_image_alpha(
-            video_frame, osd_frame, osd_pos[0], osd_pos[1], osd_zomm)
-        result = cv2.resize(video_frame, (640, 360),
-                            interpolation=cv2.INTER_AREA)
-        result = cv2.cvtColor(result, cv2.COLOR_BGR2RGB)
+    def generate_preview_at(self, time_ms, osd_pos, osd_zomm):
+        """
+        Renders the preview of the video frame shown at time_ms with the
+        OSD and SRT records the generator would put on it.
+        """
+        frame_no = self.get_frame_no(time_ms)
+        video_frame = self.get_video_frame(frame_no)
+        if video_frame is None:
+            return None
+        osd_glyphs, srt_line = self.__get_overlay_data(frame_no)
+        return self.__compose(video_frame, osd_glyphs, srt_line, osd_pos, osd_zomm)
 
-        return result
-        # return result
+    def play(self, start_ms, osd_pos, osd_zomm):
+        """
+        Yields (time_ms, preview) for consecutive video frames from
+        start_ms, paced to the video frame rate. Frames that could not be
+        rendered in time are decoded through and dropped.
+        """
+        fps = self.get_fps()
+        frame_no = self.get_frame_no(start_ms)
+        last_frame_no = len(self.__get_timeline())
+        self.video.seek(frame_no - 1)
+        started = time.monotonic()
+        first_frame_no = frame_no
+
+        while frame_no <= last_frame_no and not self.stopped:
+            due = started + (frame_no - first_frame_no) / fps
+            late = time.monotonic() - due
+            if late > 1 / fps:
+                if not self.video.skip_frame():
+                    return
+                frame_no += 1
+                continue
+
+            video_frame = self.video.read_frame()
+            if video_frame is None:
+                return
+            osd_glyphs, srt_line = self.__get_overlay_data(frame_no)
+            preview = self.__compose(self.__downsample(video_frame.data), osd_glyphs,
+                                     srt_line, osd_pos, osd_zomm)
+            if late < 0:
+                time.sleep(-late)
+            yield int((frame_no - 1) * 1000 / fps), preview
+            frame_no += 1
+
+    def __get_timeline(self):
+        if self.timeline is None:
+            srt_times = srt_ids = None
+            if self.srt and self.config.include_srt:
+                srt_times = self.srt.start_times
+                srt_ids = self.srt.get_change_ids()
+            self.timeline = OverlayTimeline(
+                self.video.get_fps(), 1, self.video.get_total_frames() + 1,
+                self.osd.records.timestamps, self.osd.records.get_change_ids(),
+                srt_times, srt_ids)
+        return self.timeline
+
+    def __get_overlay_data(self, frame_no):
+        timeline = self.__get_timeline()
+        if len(timeline) == 0:
+            return self.get_osd_glyphs(0), None
+        i = min(frame_no, len(timeline)) - 1
+        srt_line = None
+        if timeline.srt_index is not None:
+            srt_line = self.srt.get_line(int(timeline.srt_index[i]))
+        return self.get_osd_glyphs(int(timeline.osd_index[i])), srt_line
+
+    def __decode_video_frame(self, frame_no):
+        video_frame = self.video.read_frame_at(frame_no - 1)
+        return self.__downsample(video_frame.data) if video_frame else None
+
+    def __read_osd_glyphs(self, osd_index):
+        osd_frame = self.osd.peek_frame(osd_index)
+        if not osd_frame:
+            return np.full((20, 53), 32, dtype=np.uint16)
+        return osd_frame.get_osd_frame_glyphs(hide=self.config.hide_sensitive_osd)
+
+    def __compose(self, video_frame, osd_glyphs, srt_line, osd_pos, osd_zomm):
+        """
+        Composes on a frame already downsampled to PREVIEW_SIZE with a
+        preview scale glyph atlas, so the cost is a preview sized blend
+        regardless of the video resolution.
+        """
+        video_frame = video_frame.copy()
+        scale_x, scale_y = self.preview_scale
+        font = self.get_scaled_font(osd_zomm)
+        left, top = round(osd_pos[0] * scale_x), round(osd_pos[1] * scale_y)
+
+        if srt_line is not None:
+            if self.config.osd_srt:
+                video_frame = Utils.overlay_srt_line_glyphs(video_frame, font, srt_line, left)
+            else:
+                if self.config.fast_srt:
+                    srt_left = 200 if self.video.get_size()[1] > 1300 else 100
+                else:
+                    srt_left = 150 if self.font.is_hd() else 100
+                video_frame = Utils.overlay_srt_line(
+                    self.config.fast_srt, video_frame, srt_line,
+                    max(1, round(self.font.get_srt_font_size() * scale_y)),
+                    round(srt_left * scale_x))
+
+        osd_frame = font.render_glyphs(osd_glyphs)
+        y1, y2 = max(0, top), min(video_frame.shape[0], top + osd_frame.shape[0])
+        x1, x2 = max(0, left), min(video_frame.shape[1], left + osd_frame.shape[1])
+        if y1 < y2 and x1 < x2:
+            Utils.blend_over(video_frame[y1:y2, x1:x2],
+                             osd_frame[y1 - top:y2 - top, x1 - left:x2 - left])
+
+        return cv2.cvtColor(video_frame, cv2.COLOR_BGR2RGB)
 
 
 class SrtFile():
+    """
+    SRT telemetry kept in columns: start times, numeric telemetry fields
+    and pre-formatted display lines. The file is parsed once when opened,
+    the overlay timeline needs the start times of every record anyway.
+    """
+
+    FIELDS = ["Signal", "CH", "FlightTime", "SBat", "GBat", "Delay", "Bitrate", "Distance"]
+    NUMBER = re.compile(r"-?\d+(\.\d+)?")
+
     def __init__(self, path):
         self.index = 0
+        start_times = []
+        self.__data = []
+        self.__lines = []
+        values = {name: [] for name in self.FIELDS}
         with open(path, "r") as f:
-            self.subs = list(srt.parse(f, True))
+            for sub in srt.parse(f, True):
+                data = dict(x.split(":") for x in sub.content.split(" "))
+                start_times.append(sub.start.seconds * 1000 + sub.start.microseconds / 1000)
+                self.__data.append(data)
+                self.__lines.append("Signal:%1s   Delay:%5s   Bitrate:%7s   Distance:%5s" % (
+                    data["Signal"], data["Delay"],  data["Bitrate"], data["Distance"]))
+                for name, column in values.items():
+                    number = self.NUMBER.match(data.get(name, ""))
+                    column.append(float(number.group()) if number else np.nan)
+
+        self.start_times = np.array(start_times, dtype=np.float64)
+        self.lines = np.array(self.__lines, dtype=object)
+        self.__fields = {name: np.array(column, dtype=np.float64) for name, column in values.items()}
+
+    def __len__(self):
+        return len(self.__lines)
+
+    def get_field(self, name):
+        """
+        Returns the numeric values of a telemetry field for all records,
+        units are stripped (SBat:4.2V -> 4.2), missing values are NaN.
+        """
+        return self.__fields[name]
 
-    def next_data(self) -> dict:
-        if self.index >= len(self.subs):
-            self.index = len(self.subs) - 1
-        sub = self.subs[self.index]
-        data = dict(x.split(":") for x in sub.content.split(" "))
+    def get_line(self, index):
+        return self.__lines[index]
+
+    def get_data(self, index) -> dict:
         d = dict()
-        d["startTime"] = sub.start.seconds * 1000 + sub.start.microseconds / 1000
-        d["data"] = data  # sub.start.seconds / 1000 * sub.start.microseconds
-        d["line"] = "Signal:%1s   Delay:%5s   Bitrate:%7s   Distance:%5s" % (
-            data["Signal"], data["Delay"],  data["Bitrate"], data["Distance"])
+        d["startTime"] = float(self.start_times[index])
+        d["data"] = self.__data[index]
+        d["line"] = self.__lines[index]
+        return d
+
+    def next_data(self) -> dict:
+        if self.index >= len(self.__lines):
+            self.index = len(self.__lines) - 1
+        d = self.get_data(self.index)
         self.index += 1
         return d
 
+    def get_change_ids(self):
+        """
+        Returns an id per record that only increases when its display line
+        differs from the previous record.
+        """
+        lines = self.lines
+        changed = np.ones(len(lines), dtype=bool)
+        changed[1:] = lines[1:] != lines[:-1]
+        return np.cumsum(changed)
+
+
+class ByteBudgetQueue:
+    """
+    FIFO bounded by the size in bytes of the items in flight instead of
+    their count. An item counts from put() until the consumer calls
+    task_done() with its size, so it covers the item being processed as
+    well. An empty queue always accepts one item, an item larger than the
+    whole budget can't deadlock the pipeline.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.items = collections.deque()
+        self.cond = Condition()
+
+    def put(self, item, nbytes):
+        """
+        Blocks until the item fits in the budget, returns True when it
+        had to wait, i.e. the consumer side is the bottleneck.
+        """
+        blocked = False
+        with self.cond:
+            while self.used > 0 and self.used + nbytes > self.budget:
+                blocked = True
+                self.cond.wait()
+            self.items.append(item)
+            self.used += nbytes
+            self.cond.notify_all()
+        return blocked
+
+    def get(self):
+        with self.cond:
+            while not self.items:
+                self.cond.wait()
+            return self.items.popleft()
+
+    def task_done(self, nbytes):
+        with self.cond:
+            self.used -= nbytes
+            self.cond.notify_all()
+
+
+class FrameBufferPool:
+    """
+    Reusable overlay frame buffers shared by the compositor and the sinks.
+    Buffers are reference counted: acquire() hands one out with a single
+    reference, a stage that keeps a frame after the call that received it
+    takes another one with retain() and drops it with release(). The
+    buffer goes back to the pool with its last reference. Buffers are
+    allocated on first use up to max_count, then acquire() blocks until
+    one is released. Arrays that don't belong to the pool are ignored.
+    """
+
+    def __init__(self, shape, max_count):
+        self.shape = shape
+        self.max_count = max(1, max_count)
+        self.allocated = 0
+        self.free = []
+        self.refs = {}
+        self.cond = Condition()
+
+    def acquire(self):
+        with self.cond:
+            while not self.free and self.allocated >= self.max_count:
+                self.cond.wait()
+            if self.free:
+                buffer = self.free.pop()
+            else:
+                buffer = np.empty(self.shape, dtype=np.uint8)
+                self.allocated += 1
+            self.refs[id(buffer)] = 1
+            return buffer
+
+    def retain(self, buffer):
+        with self.cond:
+            if id(buffer) in self.refs:
+                self.refs[id(buffer)] += 1
+
+    def release(self, buffer):
+        with self.cond:
+            key = id(buffer)
+            if key not in self.refs:
+                return
+            self.refs[key] -= 1
+            if self.refs[key] == 0:
+                del self.refs[key]
+                self.free.append(buffer)
+                self.cond.notify()
+
+
+class FramePipeWriter:
+    """
+    Writes frames to a pipe from a background thread. The queue between
+    producer and writer is bounded, so a slow reader on the other end of
+    the pipe blocks the producer instead of letting frames pile up.
+    """
+
+    MAX_QUEUED_FRAMES = 8
+
+    def __init__(self, pipe, maxsize=MAX_QUEUED_FRAMES, pool: FrameBufferPool = None,
+                 profiler: StageProfiler = None):
+        self.pipe = pipe
+        self.pool = pool
+        self.profiler = profiler if profiler is not None else StageProfiler()
+        self.frames = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def write(self, frame):
+        if self.error is not None:
+            raise self.error
+        if self.pool is not None:
+            self.pool.retain(frame)
+        self.frames.put(frame)
+
+    def close(self):
+        self.frames.put(None)
+        self.thread.join()
+        try:
+            self.pipe.close()
+        except OSError:
+            pass
+        if self.error is not None:
+            raise self.error
+
+    def __run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            try:
+                if self.error is None:
+                    with self.profiler.measure("pipe_write"):
+                        self.pipe.write(np.ascontiguousarray(frame).data)
+            except OSError as exc:
+                self.error = exc
+            finally:
+                if self.pool is not None:
+                    self.pool.release(frame)
+
+
+class OverlaySink:
+    """
+    Destination of the generated overlay frames. write() gets every video
+    frame, changed is False when it's the same overlay as the previous one.
+    get_render_input() returns the ffmpeg input that reads the result back.
+    """
+
+    NAMES = ["png", "raw", "qtrle", "prores", "vp9"]
+    # Bytes of overlay frames queued between the compositor and the
+    # output, the peak memory of a clip is roughly this plus a few frames.
+    DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+    LOW_MEMORY_BUDGET = 32 * 1024 * 1024
+
+    def __init__(self, output_path, fps, size, memory_budget=None, low_memory=False):
+        self.output_path = output_path
+        self.fps = fps
+        self.width, self.height = size
+        self.low_memory = low_memory
+        self.profiler = StageProfiler()
+        if memory_budget is None:
+            memory_budget = self.LOW_MEMORY_BUDGET if low_memory else self.DEFAULT_MEMORY_BUDGET
+        self.memory_budget = memory_budget
+        # Enough buffers for every frame the queues can hold, plus the one
+        # being composed and the one kept for unchanged frames
+        self.pool = FrameBufferPool(
+            (self.height, self.width, 4), self.memory_budget // max(1, self.get_frame_size()) + 3)
+
+    @staticmethod
+    def create(config: OsdGenConfig, fps, size):
+        name = config.overlay_sink
+        budget = (config.memory_budget, config.low_memory)
+        if name == "png":
+            return PngSink(config.output_path, fps, size,
+                           config.sparse_output, config.png_compression, *budget)
+        elif name == "raw":
+            return RawSink(config.output_path, fps, size, *budget)
+        elif name in AlphaVideoSink.CODECS:
+            return AlphaVideoSink(config.output_path, fps, size, name, *budget)
+        else:
+            raise ValueError("Unknown overlay sink '%s', use one of %s" % (name, OverlaySink.NAMES))
+
+    def get_frame_size(self):
+        return self.width * self.height * 4
+
+    def get_queue_depth(self):
+        """Frames a FramePipeWriter may hold within the memory budget."""
+        return max(2, min(FramePipeWriter.MAX_QUEUED_FRAMES,
+                          self.memory_budget // max(1, self.get_frame_size())))
+
+    def open(self):
+        pass
+
+    def write(self, frame_no, frame, changed):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def get_render_input(self):
+        raise NotImplementedError
+
+
+class PngSink(OverlaySink):
+    """
+    Writes one PNG per frame (or per distinct overlay when sparse) through
+    a compose -> encode -> write pipeline. The queues between the stages
+    are bounded by the memory budget, encoder threads are added while the
+    compositor keeps waiting on them, up to one per CPU.
+    """
+
+    # Share of the memory budget for raw frames waiting to be encoded, the
+    # rest holds encoded PNGs waiting to be written
+    ENCODE_BUDGET_SHARE = 0.75
+
+    def __init__(self, output_path, fps, size, sparse, compression=None,
+                 memory_budget=None, low_memory=False):
+        super().__init__(output_path, fps, size, memory_budget, low_memory)
+        self.sparse = sparse
+        self.params = [] if compression is None else [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        self.max_encoders = 1 if low_memory else max(1, multiprocessing.cpu_count())
+        self.encoders = []
+        self.encode_queue = None
+        self.write_queue = None
+        self.writer = None
+        self.error = None
+        self.manifest = None
+        self.end_frame = 1
+
+    def open(self):
+        encode_budget = int(self.memory_budget * self.ENCODE_BUDGET_SHARE)
+        self.encode_queue = ByteBudgetQueue(encode_budget)
+        self.write_queue = ByteBudgetQueue(self.memory_budget - encode_budget)
+        self.encoders = []
+        self.__add_encoder()
+        self.writer = Thread(target=self.__write_files, daemon=True)
+        self.writer.start()
+        if self.sparse:
+            self.manifest = OverlayManifest(self.fps)
+
+    def write(self, frame_no, frame, changed):
+        if self.error is not None:
+            raise self.error
+        if self.manifest is None or changed:
+            file_name = "ws_%09d.png" % (frame_no)
+            self.pool.retain(frame)
+            blocked = self.encode_queue.put(
+                (os.path.join(self.output_path, file_name), frame), frame.nbytes)
+            if blocked and len(self.encoders) < self.max_encoders:
+                self.__add_encoder()
+            if self.manifest is not None:
+                self.manifest.add(file_name, frame_no)
+        self.end_frame = frame_no + 1
+
+    def close(self):
+        for _ in self.encoders:
+            self.encode_queue.put(None, 0)
+        for encoder in self.encoders:
+            encoder.join()
+        self.write_queue.put(None, 0)
+        self.writer.join()
+        logging.debug("PNG pipeline used %d encoder threads" % len(self.encoders))
+        if self.error is not None:
+            raise self.error
+        if self.manifest is not None:
+            self.manifest.write(os.path.join(self.output_path, OverlayManifest.FILE_NAME), self.end_frame)
+
+    def __add_encoder(self):
+        encoder = Thread(target=self.__encode_frames, daemon=True)
+        encoder.start()
+        self.encoders.append(encoder)
+
+    def __encode_frames(self):
+        while True:
+            job = self.encode_queue.get()
+            if job is None:
+                break
+            path, frame = job
+            try:
+                if self.error is None:
+                    with self.profiler.measure("png_encode"):
+                        _, data = cv2.imencode(".png", frame, self.params)
+                    self.write_queue.put((path, data), data.nbytes)
+            except Exception as exc:
+                self.error = exc
+            finally:
+                self.pool.release(frame)
+                self.encode_queue.task_done(frame.nbytes)
+
+    def __write_files(self):
+        while True:
+            job = self.write_queue.get()
+            if job is None:
+                break
+            path, data = job
+            try:
+                if self.error is None:
+                    with self.profiler.measure("image_write"), open(path, "wb") as f:
+                        f.write(data)
+            except OSError as exc:
+                self.error = exc
+            finally:
+                self.write_queue.task_done(data.nbytes)
+
+    def get_render_input(self):
+        if self.sparse:
+            manifest_path = os.path.join(self.output_path, OverlayManifest.FILE_NAME)
+            return ffmpeg.input(manifest_path, f="concat", safe=0)
+        else:
+            out_path = os.path.join(self.output_path, "ws_%09d.png")
+            return ffmpeg.input(out_path, framerate=self.fps)
+
+
+class RawSink(OverlaySink):
+    """
+    Uncompressed stream of BGRA frames, one per video frame, without any
+    header. Read it as rawvideo with pix_fmt bgra and the logged size.
+    """
+
+    FILE_NAME = "overlay.bgra"
+
+    def __init__(self, output_path, fps, size, memory_budget=None, low_memory=False):
+        super().__init__(output_path, fps, size, memory_budget, low_memory)
+        self.path = os.path.join(output_path, self.FILE_NAME)
+        self.writer = None
+
+    def open(self):
+        logging.info("Writing raw bgra %dx%d frames at %s fps to %s" % (
+            self.width, self.height, self.fps, self.path))
+        self.writer = FramePipeWriter(open(self.path, "wb"), self.get_queue_depth(), self.pool, self.profiler)
+
+    def write(self, frame_no, frame, changed):
+        self.writer.write(frame)
+
+    def close(self):
+        self.writer.close()
+
+    def get_render_input(self):
+        return ffmpeg.input(self.path, format="rawvideo", pix_fmt="bgra",
+                            s="%dx%d" % (self.width, self.height), framerate=self.fps)
+
+
+class AlphaVideoSink(OverlaySink):
+    """
+    Encodes the overlay into an alpha capable intermediate video with a
+    single ffmpeg process fed through a pipe.
+    """
+
+    CODECS = {
+        "qtrle": ("mov", {"c:v": "qtrle", "pix_fmt": "argb"}, {}),
+        "prores": ("mov", {"c:v": "prores_ks", "profile:v": "4444", "pix_fmt": "yuva444p10le"}, {}),
+        # The native vp9 decoder drops alpha, libvpx has to be used to read it back
+        "vp9": ("webm", {"c:v": "libvpx-vp9", "pix_fmt": "yuva420p", "crf": 20, "b:v": 0, "row-mt": 1},
+                {"c:v": "libvpx-vp9"}),
+    }
+
+    def __init__(self, output_path, fps, size, codec, memory_budget=None, low_memory=False):
+        super().__init__(output_path, fps, size, memory_budget, low_memory)
+        self.extension, self.output_args, self.input_args = self.CODECS[codec]
+        self.path = os.path.join(output_path, "overlay.%s" % self.extension)
+        self.process = None
+        self.writer = None
+
+    def open(self):
+        self.process = (
+            ffmpeg
+            .input("pipe:", format="rawvideo", pix_fmt="bgra",
+                   s="%dx%d" % (self.width, self.height), framerate=self.fps)
+            .output(self.path, **self.output_args)
+            .overwrite_output()
+            .run_async(pipe_stdin=True)
+        )
+        self.writer = FramePipeWriter(self.process.stdin, self.get_queue_depth(), self.pool, self.profiler)
+
+    def write(self, frame_no, frame, changed):
+        self.writer.write(frame)
+
+    def close(self):
+        try:
+            self.writer.close()
+        finally:
+            Utils.wait_process(self.process)
+
+    def get_render_input(self):
+        return ffmpeg.input(self.path, **self.input_args)
+
+
+class EncoderProbeCache:
+    """
+    On-disk cache of which ffmpeg encoders work on this machine, keyed by
+    the ffmpeg binary and its version, the OS and the hw flag. Encoders
+    that are not cached yet are probed concurrently, each with a timeout.
+    """
+
+    FILE_NAME = "encoders.json"
+    PROBE_TIMEOUT = 15
+    PROBE_ARGS = "-y -hwaccel auto -f lavfi -i nullsrc -c:v %s -frames:v 1 -f null -"
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else self.get_default_path()
+        self.lock = Lock()
+
+    @staticmethod
+    def get_default_path():
+        base = None
+        if platform.system() == "Windows":
+            base = os.environ.get("LOCALAPPDATA")
+        if not base:
+            base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(base, "ws-osd-py", EncoderProbeCache.FILE_NAME)
+
+    @staticmethod
+    def get_ffmpeg_path():
+        return shutil.which("ffmpeg") or "ffmpeg"
+
+    def load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def save(self, data):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        with self.lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def get_key(self, data, use_hw):
+        ffmpeg_path = self.get_ffmpeg_path()
+        return "|".join([ffmpeg_path, self.__get_ffmpeg_version(data, ffmpeg_path),
+                         platform.system().lower(), "hw" if use_hw else "sw"])
+
+    def probe(self, codec_names, use_hw, refresh=False) -> dict:
+        """
+        Returns {codec name: works} for codec_names, running ffmpeg only
+        for the ones missing from the cache (or all of them on refresh).
+        """
+        with self.lock:
+            data = self.load()
+            key = self.get_key(data, use_hw)
+            results = data.setdefault("probes", {}).setdefault(key, {})
+            missing = [name for name in codec_names if refresh or name not in results]
+            found = {name: results.get(name) for name in codec_names}
+            if missing:
+                with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                    for name, works in zip(missing, executor.map(self.__probe_codec, missing)):
+                        found[name] = works
+                        # Timeouts and failed starts are probed again next time
+                        if works is not None:
+                            results[name] = works
+                try:
+                    self.save(data)
+                except OSError as e:
+                    logging.warning("Could not write encoder cache %s: %s" % (self.path, e))
+
+            return {name: bool(works) for name, works in found.items()}
+
+    def get_working_encoder(self, codec_names, use_hw):
+        results = self.probe(codec_names, use_hw)
+        for name in codec_names:
+            if results[name]:
+                return name
+        return None
+
+    def __get_ffmpeg_version(self, data, ffmpeg_path):
+        # Asking ffmpeg for its version costs a process start, so it is
+        # remembered until the binary changes.
+        try:
+            stat = os.stat(ffmpeg_path)
+            stamp = "%d:%d" % (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            stamp = ""
+        binaries = data.setdefault("binaries", {})
+        entry = binaries.get(ffmpeg_path)
+        if stamp and entry and entry.get("stamp") == stamp:
+            return entry["version"]
+
+        try:
+            ret = subprocess.run([ffmpeg_path, "-version"], capture_output=True,
+                                 text=True, timeout=self.PROBE_TIMEOUT)
+            version = ret.stdout.splitlines()[0].strip() if ret.stdout else "unknown"
+        except (OSError, subprocess.TimeoutExpired):
+            # Not remembered, the next run asks again
+            return "unknown"
+        binaries[ffmpeg_path] = {"stamp": stamp, "version": version}
+        return version
+
+    def __probe_codec(self, codec_name):
+        """
+        True when the encoder works, False when ffmpeg rejected it and
+        None when the probe timed out or ffmpeg could not be started.
+        """
+        run_line = [self.get_ffmpeg_path()] + (self.PROBE_ARGS % codec_name).split(" ")
+        try:
+            ret = subprocess.run(run_line,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL,
+                                 timeout=self.PROBE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logging.warning("Probing codec %s timed out" % codec_name)
+            return None
+        except OSError:
+            return None
+        return ret.returncode == 0
+
+
+class RenderProfile:
+    """
+    Named sets of encoder arguments for the final render. Arguments are
+    looked up by encoder name, then by hardware backend (the part after
+    "h264_" / "hevc_"), then fall back to the generic "hw" entry.
+    """
+
+    DEFAULT = "archive-lossless"
+    PROFILES = {
+        # Visually lossless master, the historical default
+        "archive-lossless": {
+            "libx264": {"preset": "fast", "crf": 0},
+            "libx265": {"preset": "fast", "x265-params": "lossless=1"},
+            "hw": {"preset": "fast", "crf": 0, "b:v": "40M"},
+        },
+        # High quality, cheap to decode in an editor
+        "edit-intermediate": {
+            "libx264": {"preset": "fast", "crf": 12, "tune": "fastdecode", "g": 30},
+            "libx265": {"preset": "fast", "crf": 14, "g": 30},
+            "nvenc": {"preset": "fast", "b:v": "50M", "g": 30},
+            "hw": {"b:v": "50M", "g": 30},
+        },
+        # Small files that are quick to encode and upload
+        "upload-fast": {
+            "libx264": {"preset": "veryfast", "crf": 21},
+            "libx265": {"preset": "veryfast", "crf": 24},
+            "nvenc": {"preset": "fast", "b:v": "12M"},
+            "hw": {"b:v": "12M"},
+        },
+    }
+    NAMES = list(PROFILES)
 
-class ThreadPoolExecutorWithQueueSizeLimit(ThreadPoolExecutor):
-    def __init__(self, maxsize=50, *args, **kwargs):
-        super(ThreadPoolExecutorWithQueueSizeLimit,
-              self).__init__(*args, **kwargs)
-        self._work_queue = queue.Queue(maxsize=maxsize)
+    @staticmethod
+    def get_output_args(profile, encoder_name) -> dict:
+        encoders = RenderProfile.PROFILES[profile]
+        if encoder_name in encoders:
+            return dict(encoders[encoder_name])
+        backend = encoder_name.split("_", 1)[-1]
+        return dict(encoders.get(backend, encoders["hw"]))
 
 
 @dataclass()
@@ -508,39 +1827,51 @@ class CodecsList:
 
 class OsdGenerator:
 
-    def __init__(self, config: OsdGenConfig):
+    def __init__(self, config: OsdGenConfig, font: OsdFont = None):
         self.stopped = False
 
-        self.font = OsdFont(config.font_path)
+        self.font = font if font is not None else OsdFont(config.font_path)
         self.osd = OSDFile(config.osd_path, self.font)
         self.video = VideoFile(config.video_path)
         self.output = config.output_path
         self.config = config
-        self.osdGenStatus = OsdGenStatus()
+        self.profiler = StageProfiler(config.profiling)
+        self.osdGenStatus = OsdGenStatus(self.profiler)
         self.render_done = False
         self.use_hw = config.use_hw
         self.use_x264 = True
-        self.codecs = CodecsList(self.load_codecs())
+        self.codecs = CodecsList(self.load_codecs(self.use_x264, self.use_hw))
+        self.encoder_name = None
 
         if config.srt_path:
             self.srt = SrtFile(config.srt_path)
         else:
             self.srt = None
+        self.overlay_scale = self.__get_overlay_scale()
+        self.overlay_font = self.__get_overlay_font()
+        self.overlay_box = self.__get_overlay_box()
+        if config.crop_output:
+            logging.info("Overlay is cropped to %dx%d at (%d, %d)" % (
+                self.overlay_box[2], self.overlay_box[3], self.overlay_box[0], self.overlay_box[1]))
+        self.sink = OverlaySink.create(
+            config, self.video.get_fps(), self.overlay_box[2:4])
+        self.sink.profiler = self.profiler
         self.osdGenStatus.update(0, self.video.get_total_frames(), 0)
         try:
             os.mkdir(self.output)
         except:
             pass
 
-    def load_codecs(self):
+    @staticmethod
+    def load_codecs(use_x264, use_hw):
 
         macos = "darwin"
         windows = "windows"
         linux = "linux"
         codecs = []
         
-        if self.use_x264:
-            if self.use_hw:
+        if use_x264:
+            if use_hw:
                 codecs.append(CodecItem(name="h264_videotoolbox", supported_os=[macos]))
                 codecs.append(CodecItem(name="h264_nvenc", supported_os=[windows, linux]))
                 codecs.append(CodecItem(name="h264_amf", supported_os=[windows]))
@@ -551,7 +1882,7 @@ class OsdGenerator:
 
             codecs.append(CodecItem(name="libx264", supported_os=[macos, windows, linux]))
         else:
-            if self.use_hw:
+            if use_hw:
                 codecs.append(CodecItem(name="hevc_videotoolbox", supported_os=[macos]))
                 codecs.append(CodecItem(name="hevc_nvenc", supported_os=[windows, linux]))
                 codecs.append(CodecItem(name="hevc_amf", supported_os=[windows]))
@@ -566,19 +1897,27 @@ class OsdGenerator:
         return codecs
 
     def get_working_encoder(self):
-        available_codecs = self.codecs.getbyOS(platform.system().lower())
-        run_line = "ffmpeg -y -hwaccel auto -f lavfi -i nullsrc -c:v %s -frames:v 1 -f null -"
-        for codec in available_codecs:
-            runme = (run_line % codec.name).split(" ")
-            ret = subprocess.run(runme, 
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL)
-            if ret.returncode == 0:
-                logging.info("Found a working codec (%s)" % codec.name)
-                return codec.name
-            
-        raise Exception("There is no valid codedc. It should not happen")
-        
+        available_codecs = [codec.name for codec in self.codecs.getbyOS(platform.system().lower())]
+        codec_name = EncoderProbeCache().get_working_encoder(available_codecs, self.use_hw)
+        if codec_name is None:
+            raise Exception("There is no valid codedc. It should not happen")
+
+        logging.info("Found a working codec (%s)" % codec_name)
+        return codec_name
+
+    def estimate_memory(self):
+        """
+        Rough upper bound in bytes of the overlay frames this generator
+        keeps in memory at once.
+        """
+        # Queued frames plus the compositor canvas and the frame in hand
+        return self.sink.memory_budget + 2 * self.sink.get_frame_size()
+
+    def get_encoder(self):
+        if self.encoder_name is None:
+            self.encoder_name = self.get_working_encoder()
+        return self.encoder_name
+
     def start_video(self, upscale: bool):
         Thread(target=self.render, args=()).start()
         return self
@@ -590,12 +1929,6 @@ class OsdGenerator:
     def stop(self):
         self.stopped = True
 
-    @staticmethod
-    def __render_osd_frame(osd_frame_glyphs):
-        render = cv2.vconcat([cv2.hconcat(im_list_h)
-                             for im_list_h in osd_frame_glyphs])
-        return render
-
     def __overlay_osd(self, video_frame, osd_frame):
 
         alpha_mask = osd_frame[:, :, 3] / 255.0
@@ -607,125 +1940,406 @@ class OsdGenerator:
 
         return video_frame
 
-    def render(self):
-        self.osdGenStatus.update(0, 1, 0)
-
+    def __get_render_size(self):
         video_size = self.video.get_size()
         if self.config.render_upscale:
-            ff_size = {"w": 2560, "h": 1440}
+            return {"w": 2560, "h": 1440}
         else:
-            ff_size = {"w": video_size[1], "h": video_size[0]}
+            return {"w": video_size[1], "h": video_size[0]}
 
-        out_path = os.path.join(self.output, "ws_%09d.png")
-        osd_frame = (
-            ffmpeg
-            .input(out_path, framerate=60)
-            .filter("scale", **ff_size, force_original_aspect_ratio=0)
+    def __get_overlay_scale(self):
+        # The overlay is rendered natively at the output size, so ffmpeg
+        # doesn't have to rescale it on every frame.
+        img_height, img_width = self.video.get_size()
+        ff_size = self.__get_render_size()
+        return ff_size["w"] / img_width, ff_size["h"] / img_height
 
-        )
+    def __get_overlay_font(self):
+        scale_x, scale_y = self.overlay_scale
+        zoom = self.config.osd_zoom / 100
+        return self.font.scaled(scale_x * zoom, scale_y * zoom)
+
+    def __get_overlay_offset(self):
+        scale_x, scale_y = self.overlay_scale
+        return round(self.config.offset_left * scale_x), round(self.config.offset_top * scale_y)
+
+    def __get_srt_font_size(self):
+        return round(self.font.get_srt_font_size() * self.overlay_scale[1])
+
+    def __get_srt_left(self):
+        """
+        Returns the x of the SRT text within the output frame.
+        """
+        if self.config.fast_srt:
+            return 200 if self.__get_render_size()["w"] > 1300 else 100
+        return round((150 if self.font.is_hd() else 100) * self.overlay_scale[0])
+
+    def __get_srt_right(self):
+        """
+        Returns the x right of the widest SRT line within the output frame.
+        """
+        font_size = self.__get_srt_font_size()
+        lines = set(self.srt.lines)
+        if self.config.fast_srt:
+            width = max(cv2.getTextSize(line, cv2.FONT_HERSHEY_COMPLEX, 1/40 * font_size, 1)[0][0]
+                        for line in lines)
+        else:
+            font = SrtTextRenderer.load_font(font_size)
+            width = max(font.getbbox(line, anchor="lb")[2] for line in lines)
+        # Antialiasing and the stroke can reach a pixel further
+        return self.__get_srt_left() + width + 2
+
+    def __get_overlay_box(self):
+        """
+        Returns (x, y, w, h) of the overlay images within the output frame.
+        With crop_output only the OSD area and the SRT strip are kept,
+        everything else would be fully transparent anyway.
+        """
+        ff_size = self.__get_render_size()
+        width, height = ff_size["w"], ff_size["h"]
+        if not self.config.crop_output:
+            return 0, 0, width, height
+
+        left, top = self.__get_overlay_offset()
+        cell_h, _ = self.overlay_font.get_glyph_size()
+        osd_h, osd_w = self.overlay_font.get_grid_size(Frame.frame_h, Frame.frame_w)
+        x1, y1 = max(0, left), max(0, top)
+        x2 = min(width, left + osd_w)
+        y2 = min(height, top + osd_h)
+
+        if self.srt and self.config.include_srt and len(self.srt):
+            # SRT text is positioned relative to the bottom left corner,
+            # glyph rows are aligned with the OSD columns
+            if self.config.osd_srt:
+                srt_strip_height = cell_h + 15
+            else:
+                srt_strip_height = 30 + 2 * self.__get_srt_font_size()
+                x1 = max(0, min(x1, self.__get_srt_left()))
+                x2 = min(width, max(x2, self.__get_srt_right()))
+            y1, y2 = min(y1, height - srt_strip_height), height
+
+        if x1 >= x2 or y1 >= y2:
+            return 0, 0, width, height
+
+        return x1, y1, x2 - x1, y2 - y1
+
+    def __render_output(self, osd_frame, ff_size, output_path, start_frame=1, frame_count=None,
+                        profile=None, encoder_name=None):
 
         input_args = {
             "hwaccel": "auto",
         }
+        if start_frame > 1:
+            input_args["ss"] = "%.6f" % ((start_frame - 1) / self.video.get_fps())
 
         video = (
             ffmpeg
             .input(self.config.video_path, **input_args)
             .filter("scale", **ff_size, force_original_aspect_ratio=1, )
         )
-        encoder_name = self.get_working_encoder()
-        output_args = {
-            "c:v": encoder_name,
-            "preset": "fast",
-            "crf": 0,
-            "b:v": "40M",
-            "acodec": "copy"
-        }
-        self.render_done = False
-        process = (
+        if encoder_name is None:
+            encoder_name = self.get_encoder()
+        output_args = {"c:v": encoder_name}
+        output_args.update(RenderProfile.get_output_args(
+            profile or self.config.render_profile, encoder_name))
+        output_args["acodec"] = "copy"
+        if frame_count is not None:
+            output_args["frames:v"] = frame_count
+        return (
             video
             .filter("pad", **ff_size, x=-1, y=-1, color="black")
-            .overlay(osd_frame, x=0, y=0)
-            .output("%s_osd.mp4" % (self.output),  **output_args)
+            .overlay(osd_frame, x=self.overlay_box[0], y=self.overlay_box[1])
+            .output(output_path,  **output_args)
             .overwrite_output()
-            .run()
         )
+
+    def render(self):
+        self.osdGenStatus.update(0, 1, 0)
+
+        ff_size = self.__get_render_size()
+        osd_input = self.sink.get_render_input()
+
+        self.render_done = False
+        with self.profiler.measure("ffmpeg_encode"):
+            # The overlay input can run past the last video frame
+            self.__render_output(osd_input, ff_size, "%s_osd.mp4" % (self.output),
+                                 frame_count=self.video.get_total_frames()).run()
         self.render_done = True
+        self.__write_profile("render")
 
-    def main(self):
+    def render_stream(self, start_frame=1, end_frame=None, output_path=None,
+                      profile=None, encoder_name=None):
+        """
+        Single pass render, overlay frames are piped as raw BGRA video into
+        the ffmpeg process that composes them over the source video, no
+        intermediate images are written. start_frame and end_frame limit
+        the render to a part of the video, profile and encoder_name
+        override the configured ones.
+        """
+        # The last part runs to the end of the video, leave its length open
+        frame_count = None if end_frame is None else end_frame - start_frame
+        if output_path is None:
+            output_path = "%s_osd.mp4" % (self.output)
+
+        ff_size = self.__get_render_size()
+        _, _, box_w, box_h = self.overlay_box
+        osd_input = ffmpeg.input(
+            "pipe:", format="rawvideo", pix_fmt="bgra",
+            s="%dx%d" % (box_w, box_h), framerate=self.video.get_fps())
+
+        self.render_done = False
+        process = self.__render_output(
+            osd_input, ff_size, output_path, start_frame, frame_count, profile, encoder_name
+        ).run_async(pipe_stdin=True)
+        writer = FramePipeWriter(
+            process.stdin, self.sink.get_queue_depth(), self.sink.pool, self.profiler)
+        try:
+            for _, overlay, _ in self.__overlay_frames(start_frame, end_frame):
+                with self.profiler.measure("queue_wait"):
+                    writer.write(overlay)
+        finally:
+            try:
+                writer.close()
+            finally:
+                with self.profiler.measure("ffmpeg_encode"):
+                    Utils.wait_process(process)
+        self.__report_complete()
+        self.render_done = True
+        if output_path == "%s_osd.mp4" % (self.output):
+            self.__write_profile("render_stream")
+
+    @staticmethod
+    def render_segment(config: OsdGenConfig, encoder_name, start_frame, end_frame, output_path):
+        """
+        Worker process entry point of render_parallel, returns the stage
+        timing samples of the segment.
+        """
+        gen = OsdGenerator(config)
+        gen.encoder_name = encoder_name
+        try:
+            gen.render_stream(start_frame, end_frame, output_path)
+        except ffmpeg.Error as exc:
+            # ffmpeg.Error can't be unpickled in the parent process
+            raise RuntimeError("Rendering of %s failed: %s" % (output_path, exc)) from None
+        return gen.profiler.samples
+
+    def render_parallel(self, jobs):
+        """
+        Splits the video into jobs time ranges, renders each of them in its
+        own process and joins the segments without re-encoding.
+        """
+        total_frames = self.video.get_total_frames()
+        bounds = np.linspace(1, total_frames, jobs + 1).round().astype(int)
+        segments = [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+        segment_paths = ["%s_osd_%03d.mp4" % (self.output, i) for i in range(len(segments))]
+        encoder_name = self.get_encoder()
+
+        self.render_done = False
+        self.osdGenStatus.update(0, total_frames, 0)
         cps = CountsPerSec().start()
-        pr = cProfile.Profile()
-        pr.enable()
-
-        osd_time = -1
-        osd_frame = []
-        current_frame = 1
-        srt_time = -1
-        video_fps = self.video.get_fps()
+        done = 0
+        try:
+            # Forking from a thread while other threads hold locks can
+            # deadlock the children, start them fresh instead
+            with ProcessPoolExecutor(max_workers=jobs,
+                                     mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = [
+                    pool.submit(OsdGenerator.render_segment, self.config, encoder_name, start,
+                                end if i < len(segments) - 1 else None, path)
+                    for i, ((start, end), path) in enumerate(zip(segments, segment_paths))
+                ]
+                for future, (start, end) in zip(futures, segments):
+                    self.profiler.merge(future.result())
+                    done += end - start
+                    cps.increment(end - start)
+                    self.osdGenStatus.update(done, total_frames, int(cps.countsPerSec()))
+
+            with self.profiler.measure("concat"):
+                Utils.concatenate_output_files(segment_paths, "%s_osd.mp4" % (self.output))
+        finally:
+            for path in segment_paths:
+                # Segments of a failed render may never have been written
+                if os.path.exists(path):
+                    os.remove(path)
+        self.osdGenStatus.update(total_frames, total_frames, int(cps.countsPerSec()))
+        self.render_done = True
+        self.__write_profile("render_parallel")
+
+    def benchmark_profiles(self, seconds=10, profiles=None):
+        """
+        Renders the first seconds of the clip with every profile and
+        returns one dict per profile with the render fps, the output size
+        and PSNR / SSIM against a lossless libx264 render of the same
+        frames.
+        """
+        profiles = profiles or RenderProfile.NAMES
+        fps = self.video.get_fps()
+        end_frame = min(self.video.get_total_frames(), int(seconds * fps)) + 1
+        frame_count = end_frame - 1
+        reference_path = "%s_benchmark_reference.mp4" % (self.output)
+        results = []
+        try:
+            self.render_stream(1, end_frame, reference_path, RenderProfile.DEFAULT, "libx264")
+            for profile in profiles:
+                path = "%s_benchmark_%s.mp4" % (self.output, profile)
+                started = time.monotonic()
+                self.render_stream(1, end_frame, path, profile)
+                elapsed = time.monotonic() - started
+                try:
+                    psnr, ssim = Utils.compare_videos(path, reference_path)
+                    size = os.path.getsize(path)
+                finally:
+                    os.remove(path)
+                results.append({
+                    "profile": profile,
+                    "encoder": self.get_encoder(),
+                    "frames": frame_count,
+                    "fps": frame_count / elapsed if elapsed > 0 else 0,
+                    "size": size,
+                    "bitrate": size * 8 / (frame_count / fps),
+                    "psnr": psnr,
+                    "ssim": ssim,
+                })
+        finally:
+            if os.path.exists(reference_path):
+                os.remove(reference_path)
+        return results
+
+    def __create_compositor(self):
+        box_x, box_y, box_w, box_h = self.overlay_box
+        left, top = self.__get_overlay_offset()
+        return OsdCompositor(
+            self.overlay_font, (box_h, box_w), left - box_x, top - box_y)
+
+    def __compose_overlay(self, compositor, frame, raw_osd_frame, srt_line):
+        """
+        Composes the overlay into the buffer frame in place.
+        """
+        with self.profiler.measure("glyph_decode"):
+            glyph_grid = raw_osd_frame.get_osd_frame_glyphs(hide=self.config.hide_sensitive_osd)
+        with self.profiler.measure("compose"):
+            np.copyto(frame, compositor.compose(glyph_grid))
+
+        if srt_line is None:
+            return frame
+        with self.profiler.measure("srt_overlay"):
+            if self.config.osd_srt:
+                left, _ = self.__get_overlay_offset()
+                frame = Utils.overlay_srt_line_glyphs(
+                    frame, self.overlay_font, srt_line, left - self.overlay_box[0])
+            else:
+                frame = Utils.overlay_srt_line(self.config.fast_srt, frame, srt_line, self.__get_srt_font_size(
+                    ), self.__get_srt_left() - self.overlay_box[0])
+
+        return frame
+
+    def get_timeline(self, start_frame=1, end_frame=None):
+        if end_frame is None:
+            end_frame = self.video.get_total_frames()
+        srt_times = srt_ids = None
+        if self.srt and self.config.include_srt:
+            srt_times = self.srt.start_times
+            srt_ids = self.srt.get_change_ids()
+        return OverlayTimeline(
+            self.video.get_fps(), start_frame, end_frame,
+            self.osd.records.timestamps, self.osd.records.get_change_ids(),
+            srt_times, srt_ids)
+
+    def __overlay_frames(self, start_frame=1, end_frame=None):
+        """
+        Yields (frame_no, overlay, changed) for every video frame from
+        start_frame up to end_frame, changed is False when the overlay of
+        the previous frame was reused.
+        """
+        cps = CountsPerSec().start()
+        fps = 0
         total_frames = self.video.get_total_frames()
-        video_size = self.video.get_size()
-        img_height, img_width = video_size[0], video_size[1]
-        n_channels = 4
-        transparent_img = np.zeros(
-            (img_height, img_width, n_channels), dtype=np.uint8)
-        frame = transparent_img.copy()
-        executor = ThreadPoolExecutorWithQueueSizeLimit(
-            max_workers=multiprocessing.cpu_count()-1, maxsize=2000)
+        compositor = self.__create_compositor()
+        timeline = self.get_timeline(start_frame, end_frame)
+        pool = self.sink.pool
+        srt_line = None
+        result = None
 
-        while True:
+        for i, current_frame in enumerate(timeline.frames):
             if self.stopped:
                 print("Process canceled.")
                 break
 
-            frames_per_ms = 1 / video_fps * 1000
-            calc_video_time = int((current_frame - 1) * frames_per_ms)
-
-            if current_frame >= total_frames:
-                break
-
-            if osd_time < calc_video_time:
-                raw_osd_frame = self.osd.read_frame()
-                if not raw_osd_frame:
-                    break
-                frame = transparent_img.copy()
-                osd_frame = self.__render_osd_frame(
-                    raw_osd_frame.get_osd_frame_glyphs(hide=self.config.hide_sensitive_osd))
-                osd_time = raw_osd_frame.startTime
-                Utils.merge_images(frame, osd_frame, self.config.offset_left,
-                                   self.config.offset_top, self.config.osd_zoom)
-                osd_frame_no_srt = frame
-                
-            if self.srt and self.config.include_srt:
-                if srt_time < calc_video_time:
-                    srt_data = self.srt.next_data()
-                    srt_time = srt_data["startTime"]
-
-                    frame_osd_srt = Utils.overlay_srt_line(self.config.fast_srt, osd_frame_no_srt, srt_data["line"], self.font.get_srt_font_size(
-                        ), (150 if self.font.is_hd() else 100))
-                    result = frame_osd_srt
-            else:
-                result = osd_frame_no_srt
-                
-            # logging.debug(f"frame':{current_frame},'total':{total_frames},'srt':{srt_time},'osd':{osd_time},'video':{calc_video_time}")
-            out_path = os.path.join(self.output, "ws_%09d.png" % (current_frame))
-            executor.submit(cv2.imwrite, out_path, result)
+            # Most consecutive records are byte-identical, only render when
+            # the OSD payload or the SRT line actually changed.
+            if timeline.changed[i]:
+                with self.profiler.measure("osd_read"):
+                    raw_osd_frame = self.osd.peek_frame(timeline.osd_index[i])
+                if timeline.srt_index is not None:
+                    with self.profiler.measure("srt_read"):
+                        srt_line = self.srt.get_line(timeline.srt_index[i])
+                # Sinks that keep the previous frame hold their own reference
+                if result is not None:
+                    pool.release(result)
+                with self.profiler.measure("buffer_wait"):
+                    buffer = pool.acquire()
+                result = self.__compose_overlay(
+                    compositor, buffer, raw_osd_frame, srt_line)
+
+            yield int(current_frame), result, bool(timeline.changed[i])
 
-            current_frame += 1
             cps.increment()
             fps = int(cps.countsPerSec())
-            self.osdGenStatus.update(current_frame - 1, total_frames, fps)
+            self.osdGenStatus.update(current_frame, total_frames, fps)
 
             if current_frame % 200 == 0:
                 logging.debug("Current: %s/%s (fps: %d)" %
                               (current_frame, total_frames, fps))
 
-        logging.info("Waiting for jobs to complete")
-        executor.shutdown(cancel_futures=False, wait=True)
+        if result is not None:
+            pool.release(result)
+        logging.info("Overlay complete (%d frames reused unchanged overlay)" % timeline.get_deduplicated_count())
+
+    def __report_complete(self):
+        # Only once the output is complete, the GUI starts the next step
+        # as soon as the status says so.
+        total_frames = self.video.get_total_frames()
+        self.osdGenStatus.update(total_frames, total_frames, self.osdGenStatus.fps)
+
+    def main(self):
+        if self.config.profiling:
+            pr = cProfile.Profile()
+            pr.enable()
+
+        self.sink.open()
+        try:
+            for frame_no, result, overlay_changed in self.__overlay_frames():
+                with self.profiler.measure("queue_wait"):
+                    self.sink.write(frame_no, result, overlay_changed)
+        finally:
+            logging.info("Waiting for jobs to complete")
+            with self.profiler.measure("sink_close"):
+                self.sink.close()
         logging.info("Save complete")
-        self.osdGenStatus.update(total_frames, total_frames, fps)
-        pr.disable()
-        s = io.StringIO()
-        sortby = SortKey.CUMULATIVE
-        ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-        ps.print_stats()
-        logging.debug(s.getvalue())
+        self.__report_complete()
+        self.__write_profile("overlay")
+
+        if self.config.profiling:
+            pr.disable()
+            s = io.StringIO()
+            sortby = SortKey.CUMULATIVE
+            ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
+            ps.print_stats()
+            logging.debug(s.getvalue())
+
+    def get_profile_path(self):
+        return "%s_profile.json" % (self.output)
+
+    def __write_profile(self, phase):
+        """
+        Writes the stage timings collected so far, later phases of the same
+        run overwrite the report with their stages added.
+        """
+        if not self.config.profiling:
+            return
+        path = self.get_profile_path()
+        self.profiler.write_report(
+            path, phase=phase, video_path=self.config.video_path,
+            frames=self.video.get_total_frames(), overlay_sink=self.config.overlay_sink,
+            encoder=self.encoder_name, render_profile=self.config.render_profile)
+        logging.info("Stage timings written to %s\n%s" % (path, self.profiler.format_summary()))
@@ -17,6 +17,12 @@ class AppState:
         self._hide_sensitive_osd = False
         self._use_hw = False
         self._fast_srt = True
+        self._osd_srt = False
+        self._sparse_output = False
+        self._crop_output = False
+        self._overlay_sink = "png"
+        self._render_profile = "archive-lossless"
+        self._profiling = False
 
         self.offsetLeft = 0
         self.offsetTop = 0
@@ -82,7 +88,13 @@ class AppState:
             self._include_srt,
             self._hide_sensitive_osd,
             self._use_hw,
-            self._fast_srt
+            self._fast_srt,
+            self._sparse_output,
+            self._crop_output,
+            self._overlay_sink,
+            osd_srt=self._osd_srt,
+            render_profile=self._render_profile,
+            profiling=self._profiling
         )
 
     def osd_init(self) -> OsdGenStatus: